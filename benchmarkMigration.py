@@ -0,0 +1,360 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Time runMigration.py on a directory of Moin pages with different --jobs
+# settings and backends, and check they all produce the same pages.
+#
+# With --parsing, time just the parser on the same pages, in this process,
+# with and without first character dispatch and the plain page fast path.
+#
+# With --preprocessing, time getting the largest pages ready to parse, with
+# one pass per normalisation (as it used to be done) and in one stage.
+#
+# With --composing, time composing made up tables and a list with thousands of
+# rows, and how much memory that takes at its peak.
+#
+# With --streaming, time translating the largest pages into files, with each
+# page composed whole and then written, and written as it is composed, and
+# how much memory each takes at its peak.
+
+import argparse
+import glob
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import parseMoinToMarkdown
+
+
+class Argghhs(object):
+    """
+    Process and provide access to command line arguments.
+    """
+
+    def __init__(self):
+        argParser = argparse.ArgumentParser(
+            description="Time runMigration.py with process and thread workers, or time the parser alone.",
+            epilog="Example: " + os.path.basename(__file__) +
+            " --srcdir MoinPages --wikiroot /src --jobs 1 2 4")
+        argParser.add_argument(
+            "--srcdir", required=False,
+            help="Path of directory to get Moin pages from")
+        argParser.add_argument(
+            "--wikiroot", required=False, default="/src",
+            help="Root of all links used inside the wiki.  Default is /src.")
+        argParser.add_argument(
+            "--jobs", required=False, type=int, nargs="+", default=[1, 2, 4],
+            help="--jobs settings to try.  Default is 1 2 4.  1 is the plain, one page at a time, run.")
+        argParser.add_argument(
+            "--backends", required=False, nargs="+", choices=["process", "thread"],
+            default=["process", "thread"],
+            help="Backends to try.  Default is both.")
+        argParser.add_argument(
+            "--repeat", required=False, type=int, default=3,
+            help="Number of times to run each setting; the best time counts.  Default is 3.")
+        argParser.add_argument(
+            "--parsing", required=False, action="store_true",
+            help="Instead of timing whole runs, time parsing each page under --srcdir, in this process, trying every grammar alternative, with first character dispatch, and with the fast path for pages without markup.  Every way must give the same pages.")
+        argParser.add_argument(
+            "--preprocessing", required=False, type=int, default=None, metavar="NPAGES",
+            help="Instead of timing whole runs, time preprocessing the NPAGES largest pages under --srcdir, a pass at a time and in one stage.  Both ways must give the same text.")
+        argParser.add_argument(
+            "--streaming", required=False, type=int, default=None, metavar="NPAGES",
+            help="Instead of timing whole runs, translate the NPAGES largest pages under --srcdir into files, composing each page whole and writing it as it is composed, and report the time and peak memory each way takes.  Both ways must write the same pages.")
+        argParser.add_argument(
+            "--composing", required=False, type=int, default=None, metavar="NROWS",
+            help="Instead of timing whole runs, time composing a Markdown table, an HTML table and a list, each NROWS rows long, and report the peak memory composing them takes.  --srcdir is not used.")
+        self.args = argParser.parse_args()
+        if self.args.repeat < 1:
+            argParser.error("--repeat must be at least 1")
+        if self.args.srcdir is None and self.args.composing is None:
+            argParser.error("--srcdir is required")
+
+        return(None)
+
+
+def timeMigration(nJobs, backend):
+    """
+    Run runMigration.py once into a scratch directory.  Returns the seconds it
+    took and the {page: sha256} of what it wrote.
+    """
+    destDir = tempfile.mkdtemp(prefix="benchmarkMigration-")
+    try:
+        hashesPath = os.path.join(destDir, "hashes.json")
+        os.mkdir(os.path.join(destDir, "md"))
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                "runMigration.py"),
+                   "--srcdir", args.args.srcdir, "--destdir", os.path.join(destDir, "md"),
+                   "--wikiroot", args.args.wikiroot, "--hashes", hashesPath,
+                   "--jobs", str(nJobs), "--backend", backend]
+        start = time.perf_counter()
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+        seconds = time.perf_counter() - start
+        with open(hashesPath) as hashesFile:
+            hashes = json.load(hashesFile)
+    finally:
+        shutil.rmtree(destDir)
+    return(seconds, hashes)
+
+
+def gilEnabled():
+    """
+    Returns False on a free-threaded Python that is running without the GIL.
+    """
+    isGilEnabled = getattr(sys, "_is_gil_enabled", None)
+    if isGilEnabled is None:
+        return(True)
+    return(isGilEnabled())
+
+
+def parsePages(moinTexts):
+    """
+    Translate every page in moinTexts.  Returns the seconds spent parsing,
+    and what each page turned into (or why it couldn't be translated).
+    """
+    parseSeconds = 0.0
+    outputs = []
+    for moinText in moinTexts:
+        timings = {}
+        try:
+            outputs.append(parseMoinToMarkdown.translateMoinText(
+                moinText, args.args.wikiroot, 0, timings).page())
+        except Exception as e:
+            outputs.append(type(e).__name__ + ": " + str(e))
+        parseSeconds += timings.get("parse", 0.0)
+    return(parseSeconds, outputs)
+
+
+def readPages():
+    """
+    Return the text of every page under --srcdir.
+    """
+    moinTexts = []
+    for moinPage in sorted(glob.glob(os.path.join(args.args.srcdir, "**", "*.moin"),
+                                     recursive=True)):
+        with open(moinPage) as moinFile:
+            moinTexts.append(moinFile.read())
+    return(moinTexts)
+
+
+def insertIndentFlag(match):
+    return("@INDENT-" + str(len(match.group("leading"))) + "@")
+
+
+def preprocessPassAtATime(moinText):
+    """
+    Preprocess a page the way parseMoinToMarkdown used to: a pass for the non
+    breaking spaces, then a pass calling back into Python for each indent.
+    """
+    moinText = re.sub("\xa0", " ", moinText)
+    return(re.sub(r"^(?P<leading> +)(?=\S)", insertIndentFlag, moinText,
+                  flags=re.MULTILINE))
+
+
+def benchmarkPreprocessing():
+    """
+    Time preprocessing the --preprocessing largest pages under --srcdir, both
+    ways.
+    """
+    moinTexts = sorted(readPages(), key=len, reverse=True)[0:args.args.preprocessing]
+    print(str(len(moinTexts)) + " pages, " +
+          str(sum([len(moinText) for moinText in moinTexts])) + " characters, " +
+          str(sum([len(parseMoinToMarkdown.LEADING_SPACES.findall(moinText))
+                   for moinText in moinTexts])) + " indented lines")
+    print("%-16s %9s %9s %8s  %s" % ("preprocessing", "best", "median", "speedup", "output"))
+
+    baseline = None
+    expectedOutputs = None
+    for name, preprocess in [("pass at a time", preprocessPassAtATime),
+                             ("one stage", parseMoinToMarkdown.preprocess)]:
+        times = []
+        sameOutput = "same" if expectedOutputs is not None else "reference"
+        for i in range(args.args.repeat):
+            start = time.perf_counter()
+            outputs = [preprocess(moinText) for moinText in moinTexts]
+            times.append(time.perf_counter() - start)
+            if expectedOutputs is None:
+                expectedOutputs = outputs
+            elif outputs != expectedOutputs:
+                sameOutput = "DIFFERENT"
+        if baseline is None:
+            baseline = min(times)
+        print("%-16s %8.4fs %8.4fs %7.2fx  %s" % (
+            name, min(times), statistics.median(times), baseline / min(times), sameOutput))
+
+
+def composingTree(kind, nRows):
+    """
+    Make the parse tree of a table or list nRows long.  The rows are parsed
+    one at a time, as parsing thousands of them in one go is slow.
+    """
+    if kind == "list":
+        moinList = parseMoinToMarkdown.MoinList()
+        moinList.listItems = [
+            parseMoinToMarkdown.parse(
+                "@INDENT-" + str(1 + rowIdx % 3 * 2) + "@* item " + str(rowIdx) +
+                " with ''italic'' text and a [[Link|link]]\n",
+                parseMoinToMarkdown.MoinListItem)
+            for rowIdx in range(nRows)]
+        return(moinList)
+    rowTexts = ['||<rowclass="th"> Row || Name || Notes || Count ||\n']
+    if kind == "HTML table":
+        rowTexts.append('||<style="color: red"> styled || row || so || HTML ||\n')
+    for rowIdx in range(nRows - len(rowTexts)):
+        rowTexts.append("|| " + str(rowIdx) + " || ''cell'' with [[Link" + str(rowIdx) +
+                        "|a link]] || WikiWord text || " + str(rowIdx * 7) + " ||\n")
+    table = parseMoinToMarkdown.Table()
+    table.tableRows = [parseMoinToMarkdown.parse(rowText, parseMoinToMarkdown.TableRow)
+                       for rowText in rowTexts]
+    return(table)
+
+
+def benchmarkComposing():
+    """
+    Time composing --composing rows long tables and lists, and measure the
+    peak memory it takes.
+    """
+    print("%-14s %6s %9s %9s %9s %9s" % ("composing", "rows", "best", "median", "peak", "output"))
+    for kind in ["Markdown table", "HTML table", "list"]:
+        tree = composingTree(kind, args.args.composing)
+        times = []
+        for i in range(args.args.repeat):
+            start = time.perf_counter()
+            composed = parseMoinToMarkdown.compose(tree)
+            times.append(time.perf_counter() - start)
+        # Memory is measured on a run of its own, as tracing it slows things down.
+        tracemalloc.start()
+        parseMoinToMarkdown.compose(tree)
+        peakBytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print("%-14s %6d %8.3fs %8.3fs %7.1fMB %8.1fMB" % (
+            kind, args.args.composing, min(times), statistics.median(times),
+            peakBytes / 1e6, len(composed.encode("utf-8")) / 1e6))
+
+
+def benchmarkStreaming():
+    """
+    Translate the --streaming largest pages under --srcdir into files, with
+    and without streaming, and measure the time and peak memory each takes.
+    """
+    moinPages = sorted(glob.glob(os.path.join(args.args.srcdir, "**", "*.moin"), recursive=True),
+                       key=os.path.getsize, reverse=True)[0:args.args.streaming]
+    print(str(len(moinPages)) + " pages, " +
+          str(sum([os.path.getsize(moinPage) for moinPage in moinPages])) + " bytes")
+    print("%-16s %9s %9s %9s  %s" % ("writing", "best", "median", "peak", "output"))
+
+    destDir = tempfile.mkdtemp(prefix="benchmarkMigration-")
+    try:
+        expectedHashes = None
+        for name, streamPages in [("whole page", False), ("streamed", True)]:
+            parseMoinToMarkdown.streamPages = streamPages
+            times = []
+            peakBytes = 0
+            sameOutput = "same" if expectedHashes is not None else "reference"
+            for i in range(args.args.repeat + 1):
+                # The last run is traced, for its peak memory, and not timed.
+                if i == args.args.repeat:
+                    tracemalloc.start()
+                hashes = []
+                start = time.perf_counter()
+                for pageIdx, moinPage in enumerate(moinPages):
+                    timings = {}
+                    parseMoinToMarkdown.translate(
+                        moinPage, os.path.join(destDir, str(pageIdx) + ".md"),
+                        args.args.wikiroot, 0, timings)
+                    hashes.append(timings["destSha256"])
+                if i == args.args.repeat:
+                    peakBytes = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                else:
+                    times.append(time.perf_counter() - start)
+                if expectedHashes is None:
+                    expectedHashes = hashes
+                elif hashes != expectedHashes:
+                    sameOutput = "DIFFERENT"
+            print("%-16s %8.2fs %8.2fs %7.1fMB  %s" % (
+                name, min(times), statistics.median(times), peakBytes / 1e6, sameOutput))
+    finally:
+        parseMoinToMarkdown.streamPages = True
+        shutil.rmtree(destDir)
+
+
+def benchmarkParsing():
+    """
+    Time parsing every page under --srcdir, with each way of parsing.
+    """
+    moinTexts = readPages()
+    print(str(len(moinTexts)) + " pages, " +
+          str(sum([len(moinText) for moinText in moinTexts])) + " characters, " +
+          str(len([moinText for moinText in moinTexts
+                   if parseMoinToMarkdown.isPlainPage(moinText)])) + " without markup")
+    print("%-16s %9s %9s %8s  %s" % ("parsing", "best", "median", "speedup", "output"))
+
+    baseline = None
+    expectedOutputs = None
+    for name, dispatch, plainPageFastPath in [("all alternatives", False, False),
+                                              ("dispatch", True, False),
+                                              ("plain fast path", True, True)]:
+        parseMoinToMarkdown.dispatchAlternatives = dispatch
+        parseMoinToMarkdown.plainPageFastPath = plainPageFastPath
+        times = []
+        sameOutput = "same" if expectedOutputs is not None else "reference"
+        for i in range(args.args.repeat):
+            seconds, outputs = parsePages(moinTexts)
+            times.append(seconds)
+            if expectedOutputs is None:
+                expectedOutputs = outputs
+            elif outputs != expectedOutputs:
+                sameOutput = "DIFFERENT"
+        if baseline is None:
+            baseline = min(times)
+        print("%-16s %8.2fs %8.2fs %7.2fx  %s" % (
+            name, min(times), statistics.median(times), baseline / min(times), sameOutput))
+    parseMoinToMarkdown.dispatchAlternatives = True
+    parseMoinToMarkdown.plainPageFastPath = True
+
+
+if __name__ == "__main__":
+    args = Argghhs()
+
+    if args.args.parsing:
+        benchmarkParsing()
+        sys.exit(0)
+    if args.args.streaming is not None:
+        benchmarkStreaming()
+        sys.exit(0)
+    if args.args.composing is not None:
+        benchmarkComposing()
+        sys.exit(0)
+    if args.args.preprocessing is not None:
+        benchmarkPreprocessing()
+        sys.exit(0)
+
+    print("Python " + sys.version.split()[0] + ", GIL " +
+          ("enabled" if gilEnabled() else "disabled") + ", " +
+          str(os.cpu_count()) + " CPUs")
+    print("%-8s %5s %9s %9s %9s  %s" % ("backend", "jobs", "best", "median", "pages/s", "output"))
+
+    expectedHashes = None
+    for nJobs in args.args.jobs:
+        # With --jobs 1 the backend isn't used, so only run it once.
+        backends = args.args.backends if nJobs > 1 else ["serial"]
+        for backend in backends:
+            times = []
+            sameOutput = "same" if expectedHashes is not None else "reference"
+            for i in range(args.args.repeat):
+                seconds, hashes = timeMigration(nJobs, "process" if backend == "serial" else backend)
+                times.append(seconds)
+                if expectedHashes is None:
+                    expectedHashes = hashes   # everything else must match the first run
+                elif hashes != expectedHashes:
+                    sameOutput = "DIFFERENT"
+            print("%-8s %5d %8.2fs %8.2fs %9.1f  %s" % (
+                backend, nJobs, min(times), statistics.median(times),
+                len(expectedHashes) / min(times), sameOutput))
@@ -0,0 +1,169 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Merge the output of several sharded runMigration.py runs (--shard i/N) into
+# a single Markdown directory structure and a single Not Implemented report.
+
+import os
+import os.path
+import argparse
+import filecmp
+import json
+import shutil
+
+
+class Argghhs(object):
+    """
+    Process and provide access to command line arguments.
+    """
+
+    def __init__(self):
+        argParser = argparse.ArgumentParser(
+            description='Merge the translated pages and manifests of sharded runMigration.py runs.',
+            epilog = 'Example:\n    mergeMigrationShards.py --manifests shard0.json shard1.json --destdir="MarkdownPages" --manifest=merged.json')
+        argParser.add_argument(
+            "--manifests", required=True, nargs="+",
+            help="Manifests written by runMigration.py --manifest, one per shard")
+        argParser.add_argument(
+            "--shardtrees", required=False, nargs="+", default=None,
+            help="Where each shard's translated pages are on this machine, in the same order as --manifests.  By default they are looked for where they are relative to the manifest, as they were when the shard ran, and then at the shard's --destdir.")
+        argParser.add_argument(
+            "--destdir", required=True,
+            help="Path of directory to put the merged pages into")
+        argParser.add_argument(
+            "--manifest", required=False, default=None,
+            help="Write the merged manifest to this file")
+        argParser.add_argument(
+            "--hashes", required=False, default=None,
+            help="Write the sha256 of every page any shard translated to this JSON file, as runMigration.py --hashes does")
+        self.args = argParser.parse_args()
+        if (self.args.shardtrees is not None and
+            len(self.args.shardtrees) != len(self.args.manifests)):
+            argParser.error("--shardtrees needs one directory for each of --manifests")
+
+        return(None)
+
+
+def shardTree(manifestPath, manifest, shardTreeArg):
+    """
+    Return the directory the pages of a shard are in on this machine.
+
+    shardTreeArg (from --shardtrees) wins if given.  Otherwise, a shard's
+    manifest and pages are usually copied here from the host that ran it
+    together, so look where the pages were relative to the manifest, and
+    then where they were on that host.
+    """
+    if shardTreeArg is not None:
+        return(shardTreeArg)
+    if "destdirFromManifest" in manifest:
+        relativeTree = os.path.join(os.path.dirname(os.path.abspath(manifestPath)),
+                                    manifest["destdirFromManifest"])
+        if os.path.isdir(relativeTree):
+            return(relativeTree)
+    return(manifest["destdir"])
+
+
+def mergeTree(shardDir, destDir, skipFiles):
+    """
+    Copy everything under shardDir into destDir.
+
+    Shards translate disjoint sets of pages, so the only thing they should
+    share is directories.  Returns a list of files that two shards wrote with
+    different contents.
+    """
+    conflicts = []
+    for root, dirs, files in os.walk(shardDir):
+        relRoot = os.path.relpath(root, shardDir)
+        mergedRoot = os.path.normpath(os.path.join(destDir, relRoot))
+        if not os.path.exists(mergedRoot):
+            os.makedirs(mergedRoot)
+        for file in files:
+            srcFile = os.path.join(root, file)
+            if os.path.abspath(srcFile) in skipFiles:
+                continue                  # don't merge the manifests themselves
+            mergedFile = os.path.join(mergedRoot, file)
+            if os.path.exists(mergedFile) and os.path.samefile(srcFile, mergedFile):
+                continue                  # the shard wrote straight into destDir
+            if os.path.exists(mergedFile) and not filecmp.cmp(srcFile, mergedFile, shallow=False):
+                conflicts.append(mergedFile)
+            shutil.copy2(srcFile, mergedFile)
+    return(conflicts)
+
+
+args = Argghhs()
+
+manifests = []
+for manifestPath in args.args.manifests:
+    with open(manifestPath) as manifestFile:
+        manifests.append(json.load(manifestFile))
+
+skipFiles = set([os.path.abspath(manifestPath) for manifestPath in args.args.manifests])
+if not os.path.exists(args.args.destdir):
+    os.makedirs(args.args.destdir)
+
+merged = {
+    "srcdir": None,
+    "destdir": os.path.abspath(args.args.destdir),
+    "wikiroot": None,
+    "shards": [],
+    "pages": [],
+    "notImplementedPages": [],
+    "failedPages": [],
+    "pageKinds": {},
+    "hashes": {}}
+conflicts = []
+shardTreeArgs = args.args.shardtrees or [None] * len(manifests)
+for manifestPath, manifest, shardTreeArg in zip(args.args.manifests, manifests, shardTreeArgs):
+    print("SHARD:", manifest["shard"], manifestPath)
+    if merged["wikiroot"] is None:
+        merged["srcdir"] = manifest["srcdir"]
+        merged["wikiroot"] = manifest["wikiroot"]
+    elif merged["wikiroot"] != manifest["wikiroot"]:
+        print("Warning: " + manifestPath + " used wikiroot " + manifest["wikiroot"] +
+              ", not " + merged["wikiroot"])
+    merged["shards"].append(manifest["shard"])
+    merged["pages"] += manifest["pages"]
+    merged["notImplementedPages"] += manifest["notImplementedPages"]
+    merged["failedPages"] += manifest.get("failedPages", [])
+    merged["pageKinds"].update(manifest.get("pageKinds", {}))
+    merged["hashes"].update(manifest.get("hashes", {}))
+    shardDir = shardTree(manifestPath, manifest, shardTreeArg)
+    if not os.path.isdir(shardDir):
+        print("Warning: can't find the pages of " + manifestPath + " at " + shardDir +
+              "; use --shardtrees to say where they are")
+        continue
+    conflicts += mergeTree(shardDir, args.args.destdir, skipFiles)
+
+merged["pages"].sort()
+merged["notImplementedPages"].sort()
+merged["failedPages"].sort()
+merged["pageKinds"] = dict(sorted(merged["pageKinds"].items()))
+merged["hashes"] = dict(sorted(merged["hashes"].items()))
+
+nShards = set([shard.split("/")[1] for shard in merged["shards"] if shard])
+if len(nShards) > 1:
+    print("Warning: merging runs with different shard counts: " + ", ".join(sorted(nShards)))
+
+for conflict in conflicts:
+    print("Warning: more than one shard wrote " + conflict)
+
+if args.args.manifest:
+    with open(args.args.manifest, "w") as manifestFile:
+        json.dump(merged, manifestFile, indent=2)
+        manifestFile.write("\n")
+
+if args.args.hashes:
+    with open(args.args.hashes, "w") as hashesFile:
+        json.dump(merged["hashes"], hashesFile, indent=2, sort_keys=True)
+        hashesFile.write("\n")
+
+print("Number of pages: " + str(len(merged["pages"])))
+print("Number of Not Implemented pages: " + str(len(merged["notImplementedPages"])))
+for probs in merged["notImplementedPages"]:
+    print("  Page: " + probs[0])
+    print("            Err: " + probs[1] + "\n")
+if merged["failedPages"]:
+    print("Number of failed pages: " + str(len(merged["failedPages"])))
+    for probs in merged["failedPages"]:
+        print("  Page: " + probs[0])
+        print("            Err: " + probs[1] + "\n")
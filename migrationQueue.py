@@ -0,0 +1,225 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+#
+# SQLite backed work queue for runMigration.py.
+#
+# Every page to translate is a row in the pages table.  Pages move from
+# pending to claimed to done or failed.  Any number of worker processes, on
+# any number of machines that can see the database file, can claim pages from
+# the same queue.  Claims that aren't finished within the lease time are
+# assumed to belong to a crashed worker and are handed out again.
+#
+# Note: SQLite relies on file locking.  Some network filesystems don't
+# implement locking properly; put the queue on one that does.
+
+import os
+import socket
+import sqlite3
+import time
+
+
+PAGE_STATES = ["pending", "claimed", "done", "failed"]
+
+TIMING_COLUMNS = ["total", "read", "preprocess", "parse", "compose", "write",
+                  "srcBytes", "destBytes"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    page       TEXT PRIMARY KEY,      -- path of the Moin file, relative to srcdir
+    state      TEXT NOT NULL DEFAULT 'pending',
+    cost       REAL NOT NULL DEFAULT 0, -- expected cost; costly pages are handed out first
+    walkOrder  INTEGER NOT NULL DEFAULT 0, -- position in the page list; breaks ties in cost
+    worker     TEXT,
+    claimedAt  REAL,
+    finishedAt REAL,
+    attempts   INTEGER NOT NULL DEFAULT 0,
+    error      TEXT,
+    total      REAL,
+    read       REAL,
+    preprocess REAL,
+    parse      REAL,
+    compose    REAL,
+    write      REAL,
+    srcBytes   INTEGER,
+    destBytes  INTEGER
+);
+CREATE INDEX IF NOT EXISTS pagesByState ON pages (state);
+CREATE TABLE IF NOT EXISTS queueInfo (
+    name  TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class MigrationQueue(object):
+    """
+    A queue of pages to translate, shared between workers through an SQLite
+    database file.
+    """
+
+    def __init__(self, dbPath, lease=600):
+        """
+        dbPath: SQLite database file; created if it does not exist.
+        lease: seconds a worker can hold a claim before it is handed out again.
+        """
+        self.dbPath = dbPath
+        self.lease = lease
+        self.worker = socket.gethostname() + ":" + str(os.getpid())
+        # Autocommit; we start our own transactions when we need them.
+        self.db = sqlite3.connect(dbPath, timeout=60, isolation_level=None)
+        self.db.executescript(SCHEMA)
+        self.upgrade()
+
+        return(None)
+
+    def upgrade(self):
+        """
+        Bring a queue made by an older runMigration.py up to date, so it can
+        still be resumed.  CREATE TABLE IF NOT EXISTS leaves an existing
+        table as it is, so columns added since have to be added here.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            columns = [row[1] for row in self.db.execute("PRAGMA table_info(pages)")]
+            if "cost" not in columns:
+                self.db.execute("ALTER TABLE pages ADD COLUMN cost REAL NOT NULL DEFAULT 0")
+            if "walkOrder" not in columns:
+                self.db.execute("ALTER TABLE pages ADD COLUMN walkOrder INTEGER NOT NULL DEFAULT 0")
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        self.db.close()
+
+    def isLoaded(self):
+        """
+        Returns true if the queue has already been filled with pages.
+        """
+        row = self.db.execute(
+            "SELECT value FROM queueInfo WHERE name = 'loadedAt'").fetchone()
+        return(row is not None)
+
+    def load(self, pages, costs=None):
+        """
+        Add every page in pages to the queue, unless the queue is already
+        loaded.  Returns the number of pages added.
+
+        costs: dict of page: expected cost.  Pages with the highest cost are
+        claimed first, and pages that cost the same in the order they are in
+        pages.  None to claim pages in the order they are in pages.
+
+        Safe to call from many workers at once; only the first one does anything.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            if self.isLoaded():
+                self.db.execute("COMMIT")
+                return(0)
+            nBefore = self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            if costs is None:
+                costs = {}
+            self.db.executemany(
+                "INSERT OR IGNORE INTO pages (page, cost, walkOrder) VALUES (?, ?, ?)",
+                [(page, costs.get(page, 0), walkOrder) for walkOrder, page in enumerate(pages)])
+            nAfter = self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+            self.db.execute(
+                "INSERT INTO queueInfo (name, value) VALUES ('loadedAt', ?)",
+                (str(time.time()),))
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        return(nAfter - nBefore)
+
+    def claim(self):
+        """
+        Claim the next page that needs translating: a pending page, or one
+        whose claim has expired.  Returns the page, or None if there is
+        nothing left to do.
+        """
+        now = time.time()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT page FROM pages "
+                "WHERE state = 'pending' OR (state = 'claimed' AND claimedAt < ?) "
+                "ORDER BY state DESC, cost DESC, walkOrder, page LIMIT 1",
+                (now - self.lease,)).fetchone()
+            if row is None:
+                self.db.execute("COMMIT")
+                return(None)
+            self.db.execute(
+                "UPDATE pages SET state = 'claimed', worker = ?, claimedAt = ?, "
+                "attempts = attempts + 1 WHERE page = ?",
+                (self.worker, now, row[0]))
+            self.db.execute("COMMIT")
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        return(row[0])
+
+    def finish(self, page, state, record=None, error=None):
+        """
+        Record that this worker is done with page.
+
+        state: "done" or "failed"
+        record: timing record from runMigration.translatePage, or None
+        error: why the page failed, or None
+
+        Returns False if our claim expired and another worker now owns the page.
+        """
+        values = [state, time.time(), error]
+        for column in TIMING_COLUMNS:
+            if record is None:
+                values.append(None)
+            else:
+                values.append(record.get(column))
+        cursor = self.db.execute(
+            "UPDATE pages SET state = ?, finishedAt = ?, error = ?, " +
+            ", ".join([column + " = ?" for column in TIMING_COLUMNS]) +
+            " WHERE page = ? AND state = 'claimed' AND worker = ?",
+            values + [page, self.worker])
+        return(cursor.rowcount == 1)
+
+    def counts(self):
+        """
+        Returns a dict of the number of pages in each state, plus the number of
+        claims that have expired.
+        """
+        counts = dict([(state, 0) for state in PAGE_STATES])
+        for state, count in self.db.execute(
+                "SELECT state, COUNT(*) FROM pages GROUP BY state"):
+            counts[state] = count
+        counts["expired"] = self.db.execute(
+            "SELECT COUNT(*) FROM pages WHERE state = 'claimed' AND claimedAt < ?",
+            (time.time() - self.lease,)).fetchone()[0]
+        return(counts)
+
+    def failures(self):
+        """
+        Returns a list of [page, error] for every page that failed.
+        """
+        return([list(row) for row in self.db.execute(
+            "SELECT page, error FROM pages WHERE state = 'failed' ORDER BY page")])
+
+    def printStatus(self):
+        """
+        Print how far along the queue is.
+        """
+        counts = self.counts()
+        nPages = sum([counts[state] for state in PAGE_STATES])
+        print("Queue " + self.dbPath + ": " + str(nPages) + " pages")
+        print("  pending: %d, claimed: %d (%d expired), done: %d, failed: %d" % (
+            counts["pending"], counts["claimed"], counts["expired"],
+            counts["done"], counts["failed"]))
+        workerSeconds, srcBytes, nWorkers = self.db.execute(
+            "SELECT SUM(total), SUM(srcBytes), COUNT(DISTINCT worker) FROM pages "
+            "WHERE state = 'done'").fetchone()
+        if workerSeconds:
+            print("  translated %d bytes in %.1f worker seconds (%.0f bytes/s) using %d workers" % (
+                srcBytes, workerSeconds, srcBytes / workerSeconds, nWorkers))
+        for page, error in self.failures():
+            print("  Page: " + page)
+            print("            Err: " + str(error) + "\n")
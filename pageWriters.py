@@ -0,0 +1,312 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Ways of writing translated pages out, for runMigration.py.
+#
+# A page writer is called as writer.write(destFilePath, markdownText), which
+# is the interface parseMoinToMarkdown.translate's writer argument expects.
+# close() must be called once all pages have been handed over; it raises if
+# any page could not be written.  Writers raise WriteError when they can't go
+# on writing pages, so callers can tell that apart from a page that failed.
+
+import gzip
+import io
+import os
+import queue
+import tarfile
+import threading
+import time
+import zipfile
+
+
+# Archive name endings, and the tarfile mode (or "zip", or "gz") to write them
+# with.  Tar archives are written as a stream, so nothing is ever seeked back
+# over.  Gzipped tars are compressed by us rather than tarfile, which would put
+# the current time in the gzip header.
+ARCHIVE_FORMATS = [
+    (".zip", "zip"),
+    (".tar", "w|"),
+    (".tar.gz", "gz"),
+    (".tgz", "gz"),
+    (".tar.bz2", "w|bz2"),
+    (".tar.xz", "w|xz")]
+
+
+def archiveTimestamp():
+    """
+    Timestamp to give everything in an archive, so that the same pages always
+    make the same archive.  Honours SOURCE_DATE_EPOCH, like other reproducible
+    build tools; otherwise the start of 1980, the earliest a zip can store.
+    """
+    return(int(os.environ.get("SOURCE_DATE_EPOCH", 315532800)))
+
+
+def archiveFormat(archivePath):
+    """
+    Return the format to write archivePath in, or None if we don't know how.
+    """
+    for ending, archiveMode in ARCHIVE_FORMATS:
+        if archivePath.lower().endswith(ending):
+            return(archiveMode)
+    return(None)
+
+
+class WriteError(IOError):
+    """
+    A page writer failed, so pages handed to it may not have been written.
+    """
+    pass
+
+
+class BackgroundWriter(object):
+    """
+    Write pages from a background thread, so translating the next page doesn't
+    wait on the disk (or on a slow network filesystem).
+
+    Pages are handed over through a bounded queue; if the disk falls too far
+    behind, write() blocks until it catches up.  The thread takes pages off
+    the queue in batches, and for each batch:
+      - creates any directories the batch needs (each directory only once)
+      - writes each page to a temporary file next to it
+      - optionally fsyncs the files, then
+      - renames the temporary files into place, so a page is never seen
+        half written, and fsyncs the directories they are in.
+    """
+
+    def __init__(self, maxPending=256, batchSize=32, fsync=False):
+        """
+        maxPending: number of pages that can be waiting to be written.
+        batchSize: most pages to write in one go.
+        fsync: fsync files and their directories after each batch.
+        """
+        self.batchSize = batchSize
+        self.fsync = fsync
+        self.pending = queue.Queue(maxPending)
+        self.madeDirs = set()
+        self.error = None                 # first exception the thread hit
+        self.nWritten = 0
+        self.nBatches = 0
+        self.thread = threading.Thread(target=self.run, name="BackgroundWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+        return(None)
+
+    def write(self, destFilePath, markdownText):
+        """
+        Queue a page to be written.  Raises the error the writer thread hit,
+        if writing an earlier page failed.
+        """
+        self.raiseError()
+        self.pending.put((destFilePath, markdownText))
+
+    def flush(self):
+        """
+        Wait until every page handed over so far has been written.
+        """
+        self.pending.join()
+        self.raiseError()
+
+    def close(self):
+        """
+        Write any remaining pages and stop the thread.
+        """
+        self.pending.put(None)
+        self.thread.join()
+        self.raiseError()
+
+    def raiseError(self):
+        if self.error is not None:
+            raise WriteError("Background write failed: " + str(self.error)) from self.error
+
+    def run(self):
+        while True:
+            batch = [self.pending.get()]
+            while batch[-1] is not None and len(batch) < self.batchSize:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            pages = [page for page in batch if page is not None]
+            if self.error is None and pages:
+                try:
+                    self.writeBatch(pages)
+                except Exception as e:
+                    self.error = e        # drop the rest; write() reports it
+            for page in batch:
+                self.pending.task_done()
+            if batch[-1] is None:
+                return
+
+    def writeBatch(self, pages):
+        dirPaths = sorted(set([os.path.dirname(destFilePath) for destFilePath, text in pages]))
+        for dirPath in dirPaths:
+            if dirPath not in self.madeDirs:
+                os.makedirs(dirPath, exist_ok=True)
+                self.madeDirs.add(dirPath)
+
+        written = []
+        try:
+            for destFilePath, markdownText in pages:
+                tmpFilePath = destFilePath + ".tmp"
+                tmpFile = open(tmpFilePath, "w")
+                written.append((tmpFile, tmpFilePath, destFilePath))
+                tmpFile.write(markdownText)
+            for tmpFile, tmpFilePath, destFilePath in written:
+                tmpFile.flush()
+                if self.fsync:
+                    os.fsync(tmpFile.fileno())
+                tmpFile.close()
+                os.replace(tmpFilePath, destFilePath)
+        except:
+            for tmpFile, tmpFilePath, destFilePath in written:
+                tmpFile.close()
+                if os.path.exists(tmpFilePath):
+                    os.remove(tmpFilePath)
+            raise
+
+        if self.fsync:
+            # Make the renames themselves durable.
+            for dirPath in dirPaths:
+                dirFd = os.open(dirPath, os.O_RDONLY)
+                try:
+                    os.fsync(dirFd)
+                finally:
+                    os.close(dirFd)
+        self.nWritten += len(pages)
+        self.nBatches += 1
+
+
+class ArchiveWriter(object):
+    """
+    Stream pages straight into a tar or zip archive, instead of into files.
+
+    Each page is named in the archive by its path relative to rootDir, so
+    the archive holds the same tree runMigration.py would otherwise create.
+
+    Every page gets the same timestamp, owner and permissions, so handing the
+    same pages over in the same order always produces the same bytes.
+    """
+
+    def __init__(self, archivePath, rootDir):
+        """
+        archivePath: archive to create; the format comes from its name (see
+                     ARCHIVE_FORMATS).
+        rootDir: directory the destination paths handed to write() are in.
+        """
+        self.archivePath = archivePath
+        self.rootDir = rootDir
+        self.archiveMode = archiveFormat(archivePath)
+        if self.archiveMode is None:
+            raise ValueError("Don't know how to write an archive named " + archivePath)
+        self.timestamp = archiveTimestamp()
+        self.gzipFile = None
+        self.rawFile = None
+        if self.archiveMode == "zip":
+            self.archive = zipfile.ZipFile(archivePath, "w", zipfile.ZIP_DEFLATED)
+        elif self.archiveMode == "gz":
+            # No file name in the gzip header either; only the pages count.
+            self.rawFile = open(archivePath, "wb")
+            self.gzipFile = gzip.GzipFile("", "wb", fileobj=self.rawFile, mtime=self.timestamp)
+            self.archive = tarfile.open(fileobj=self.gzipFile, mode="w|",
+                                        format=tarfile.PAX_FORMAT)
+        else:
+            self.archive = tarfile.open(archivePath, self.archiveMode,
+                                        format=tarfile.PAX_FORMAT)
+        self.nWritten = 0
+
+        return(None)
+
+    def write(self, destFilePath, markdownText):
+        memberName = os.path.relpath(destFilePath, self.rootDir).replace(os.sep, "/")
+        data = markdownText.encode("utf-8")
+        try:
+            if self.archiveMode == "zip":
+                member = zipfile.ZipInfo(memberName, time.gmtime(self.timestamp)[0:6])
+                member.compress_type = zipfile.ZIP_DEFLATED
+                member.external_attr = 0o644 << 16
+                self.archive.writestr(member, data)
+            else:
+                member = tarfile.TarInfo(memberName)
+                member.size = len(data)
+                member.mtime = self.timestamp
+                member.mode = 0o644
+                self.archive.addfile(member, io.BytesIO(data))
+        except OSError as e:
+            raise WriteError("Archive write failed: " + str(e)) from e
+        self.nWritten += 1
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.archive.close()
+        if self.gzipFile is not None:
+            self.gzipFile.close()
+            self.rawFile.close()
+
+
+class CollectingWriter(object):
+    """
+    Hold on to pages instead of writing them, so another process can write
+    them.  runMigration.py --jobs workers use this to send pages back to the
+    process that owns the archive.
+    """
+
+    def __init__(self):
+        self.pages = []
+
+        return(None)
+
+    def write(self, destFilePath, markdownText):
+        self.pages.append((destFilePath, markdownText))
+
+    def take(self):
+        """
+        Return the pages written since the last take().
+        """
+        pages = self.pages
+        self.pages = []
+        return(pages)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReorderingWriter(object):
+    """
+    Hand pages to another writer in a fixed order, no matter what order they
+    are finished in, so an archive comes out the same every time.  Pages that
+    are finished early wait here until everything before them is done.
+
+    Safe to call from several threads.
+    """
+
+    def __init__(self, writer, order):
+        """
+        writer: where to write pages, in order.
+        order: list of keys (e.g. page names), in the order to write them.
+        """
+        self.writer = writer
+        self.order = order
+        self.nextIndex = 0                # index in order of the next key to write
+        self.finished = {}                # key: pages, waiting for their turn
+        self.lock = threading.Lock()
+
+        return(None)
+
+    def finish(self, key, pages):
+        """
+        Record that key is done, and produced pages, a list of
+        (destFilePath, markdownText).  Writes whatever is now in order.
+        """
+        with self.lock:
+            self.finished[key] = pages
+            while (self.nextIndex < len(self.order) and
+                   self.order[self.nextIndex] in self.finished):
+                for destFilePath, markdownText in self.finished.pop(self.order[self.nextIndex]):
+                    self.writer.write(destFilePath, markdownText)
+                self.nextIndex += 1
@@ -11,10 +11,276 @@
 
 
 import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
 from pypeg2 import *                           # parser library.
 import re
 import os
 import os.path
+import sys
+import tempfile
+import time
+
+
+# ################
+# Translation state
+# ################
+
+class TranslationContext(object):
+    """
+    Everything the translation of one page needs to remember as it goes.
+
+    Each page gets its own context, so any number of pages can be translated
+    at once, in different threads.
+    """
+
+    def __init__(self, wikiRoot="/src", pageDepth=0):
+        """
+        wikiRoot: used to generate all absolute links.
+        pageDepth: used to generate relative URLs.  0 = top
+        """
+        self.wikiRoot = wikiRoot
+        self.wikiRootParts = wikiRoot.split("/")
+        self.wikiRootParts.pop(0)         # first one is empty
+        self.pageDepth = pageDepth
+
+        # Each page can have leading YAML; whatever generates it adds it here.
+        self.pageYaml = {}
+
+        # Markup that is turned on and off, in HTML.
+        self.inUnderline = False
+        self.inBold = False
+        self.inItalic = False
+        self.inCodeBlock = False
+
+        # Where we are in a MoinList.
+        self.listIndentLevel = 0
+        self.listIndentBase = 0
+
+        # Warnings about the page, from whatever is composed.
+        self.warnings = []
+
+        return(None)
+
+    def diagnostics(self):
+        """
+        Returns the warnings about the page, once it has been composed: those
+        made while composing it, then any state it left unrestored.
+        """
+        return(self.warnings + self.unrestoredState())
+
+    def unrestoredState(self):
+        """
+        Some state should be back where it started by the end of a page.
+        However, sometimes the input text doesn't close a tag as it should.
+
+        Returns a list of warnings about any state that wasn't restored.
+        """
+        warnings = []
+        for name in ["inUnderline", "inBold", "inItalic", "inCodeBlock"]:
+            if getattr(self, name):
+                warnings.append(name + " not restored to correct value, = " +
+                                str(getattr(self, name)))
+        # listIndentLevel can end up at 0 or 1, so don't report on it.
+        if self.listIndentBase:
+            warnings.append("listIndentBase not restored to correct value, = " +
+                            str(self.listIndentBase))
+        return(warnings)
+
+
+class MoinParser(Parser):
+    """
+    A pypeg2 Parser that carries the TranslationContext of the page being
+    translated.  Compose methods get at it as parser.context.
+    """
+
+    def __init__(self, context):
+        Parser.__init__(self)
+        self.context = context
+
+        return(None)
+
+
+def compose(thing, parser=None):
+    """
+    Compose thing, as pypeg2's compose does, in the context of parser (the
+    MoinParser whose compose method is calling this), or in a new context if
+    there is no parser.
+
+    Like pypeg2's compose, every call gets a parser of its own, so that pypeg2's
+    bookkeeping doesn't carry over from one call to the next.  Only the context
+    is shared.
+
+    Things with a compose method of their own don't need any of pypeg2's
+    bookkeeping; their compose methods only use the parser for its context.
+    They are handed parser as it is, which saves making a parser, and going
+    through pypeg2, for every bit of every page.
+    """
+    if parser is None:
+        return(MoinParser(TranslationContext()).compose(thing))
+    if hasattr(type(thing), "compose"):
+        return(thing.compose(parser, None))
+    return(MoinParser(parser.context).compose(thing))
+
+
+# ################
+# Packrat parsing
+# ################
+
+class PackratResults(dict):
+    """
+    Parse results for one grammar thing, keyed by position in the page.
+
+    pypeg2 memoizes by the text left to parse.  Within one parse that is
+    always the tail of the same page, so its length identifies it, and an int
+    is much cheaper to look up than a string that has to be hashed and
+    compared.
+    """
+
+    def __init__(self, memo):
+        dict.__init__(self)
+        self.memo = memo                  # PackratMemo to count lookups in
+
+        return(None)
+
+    def __getitem__(self, text):
+        self.memo.lookups += 1
+        result = dict.__getitem__(self, len(text))
+        self.memo.hits += 1
+        return(result)
+
+    def __setitem__(self, text, result):
+        dict.__setitem__(self, len(text), result)
+
+
+class PackratMemo(dict):
+    """
+    Stands in for a pypeg2 Parser's memo (Parser._memory), which maps id(thing)
+    to that thing's results.  Counts lookups and hits.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self.lookups = 0
+        self.hits = 0
+
+        return(None)
+
+    def __missing__(self, thingId):
+        results = PackratResults(self)
+        dict.__setitem__(self, thingId, results)
+        return(results)
+
+
+class PackratParser(Parser):
+    """
+    A pypeg2 Parser that remembers the result of trying each grammar thing at
+    each position, for one parse.  Use a new one for each page.
+    """
+
+    def __init__(self):
+        Parser.__init__(self)
+        self._memory = PackratMemo()
+
+        return(None)
+
+
+def packratParse(text, thing, stats=None):
+    """
+    Parse text as thing, as pypeg2's parse does, with a PackratParser.
+
+    If stats is a dict, the number of memo lookups and hits are put in it,
+    as packratLookups and packratHits.
+    """
+    parser = PackratParser()
+    parser.text = text
+    unparsed, parsed = parser.parse(text, thing)
+    if stats is not None:
+        stats["packratLookups"] = parser._memory.lookups
+        stats["packratHits"] = parser._memory.hits
+    if unparsed:
+        raise parser.last_error
+    return(parsed)
+
+
+# ################
+# First character dispatch
+# ################
+
+# Subelement and Element try a long list of alternatives at every position.
+# Most alternatives can only match text that starts with particular
+# characters, which they list in leadCharacters (no leadCharacters: could
+# start with anything).  Set to False to try every alternative, everywhere.
+dispatchAlternatives = True
+
+dispatchTables = {}                       # class: {lead character: grammar}
+
+
+def dispatchTable(cls):
+    """
+    Return the dispatch table for cls, whose grammar is contiguous([...]).
+
+    The table maps each lead character to the grammar to try when the text
+    starts with it: the alternatives that can start with that character, or
+    with anything, in their original order.  None maps to the grammar for
+    every other character.
+    """
+    if cls not in dispatchTables:
+        alternatives = cls.grammar[-1]
+        leads = set()
+        for alternative in alternatives:
+            leads.update(getattr(alternative, "leadCharacters", ""))
+        table = {}
+        for lead in list(leads) + [None]:
+            table[lead] = contiguous(
+                [alternative for alternative in alternatives
+                 if not hasattr(alternative, "leadCharacters") or
+                 (lead is not None and lead in alternative.leadCharacters)])
+        dispatchTables[cls] = table
+    return(dispatchTables[cls])
+
+
+def dispatchParse(cls, parser, text, pos):
+    """
+    Parse one of cls's alternatives, trying only the ones that can start
+    with the next character of text.  Gives the same result as pypeg2 trying
+    all of them.  Called as cls.parse.
+    """
+    try:
+        result = parser._memory[id(cls)][text]
+    except KeyError:
+        if dispatchAlternatives:
+            table = dispatchTable(cls)
+            grammar = table.get(text[:1], table[None])
+        else:
+            grammar = cls.grammar
+        startPos = tuple(pos)
+        unparsed, parsed = parser._parse(text, grammar, pos)
+        if isinstance(parsed, SyntaxError):
+            # Report it as pypeg2 would have, naming every alternative.
+            parsed = parser.generate_syntax_error("expecting one of " + repr(cls.grammar[-1]), pos)
+            parser.last_error = parsed
+            result = (text, parsed)
+        else:
+            thing = cls()
+            thing.append(parsed)
+            thing.position_in_text = startPos
+            result = (unparsed, thing)
+        try:
+            parser._memory[id(cls)][text] = result
+        except KeyError:
+            parser._memory[id(cls)] = {text: result}
+
+    if not isinstance(result[1], SyntaxError):
+        # pypeg2 moves pos past the text a parse method consumed, once it
+        # returns.  Parsing the alternative has already moved it (or, for a
+        # remembered result, pypeg2 wouldn't have moved it), so take that off.
+        consumed = text[:len(text) - len(result[0])]
+        pos[0] -= consumed.count("\n")
+        pos[1] -= len(consumed)
+    return(result)
 
 
 # ################
@@ -22,22 +288,45 @@ import os.path
 # ################
 
 class TrailingWhitespace(List):
+    leadCharacters = " \t\f\v\n"
     grammar = contiguous(re.compile(r"[ \t\f\v]*\n", re.MULTILINE))
 
     def compose(self, parser, attr_of):
         return ("\n")
 
 
+# A punctuation character that can't start any other Subelement, so it would
+# be a Punctuation on its own anyway.  Characters that are the lead character
+# of something else only count when what follows rules that something out;
+# otherwise they are left for the other Subelements to try.
+PUNCTUATION_RUN_CHARACTER = (
+    r"[^\w\s@/^\-'~+{`}!<\[|]"
+    r"|-(?!-\(.+?\)--|~)"                # StrikeThroughText, FontSizeChangeEnd
+    r"|\+(?!~)"                           # FontSizeChangeEnd
+    r"|~(?![+\-])"                        # FontSizeChangeStart
+    r"|'(?!')"                            # Bold, Italic
+    r"|!(?![/A-Z])"                       # SuppressedWikiWord
+    r"|@(?!INDENT-)"                      # LeadingSpaces
+    r"|/(?![A-Z*])"                       # WikiWord, InlineComment
+    r"|\{(?!\{)"                          # Image, Monospace, CodeBlock, CodeBlockStart
+    r"|\}(?!\})"                          # CodeBlockEnd
+    r"|<(?!<)"                            # Macro
+    r"|\[(?!\[)"                          # Link
+    r"|\|(?!\|)")                         # the end of a table cell
+
+
 class Punctuation(List):
     """
     Characters that aren't included in plaintext or other tokens
 
-    Matches a single character.
+    Matches as long a run of characters as can't start anything else, or
+    failing that a single character.
     Prevent matching with table cell ending.
     """
     grammar = contiguous(
         # attr("punctuation", re.compile(r"([^\w\s\|])|(\|(?=[^\|]|$))")))
-        attr("punctuation", re.compile(r"([^\w\s\|\<])|(\|(?=[^\|]|$))|(\<(?=[^\<]|$))")))
+        attr("punctuation", re.compile(r"(?:" + PUNCTUATION_RUN_CHARACTER + r")+|" +
+                                       r"([^\w\s\|\<])|(\|(?=[^\|]|$))|(\<(?=[^\<]|$))")))
 
     def compose(self, parser, attr_of):
         """
@@ -45,11 +334,11 @@ class Punctuation(List):
         """
         return(self.punctuation)
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         For now use same as Markdown.
         """
-        return(compose(self))
+        return(compose(self, parser))
 
         
     @classmethod
@@ -62,6 +351,11 @@ class Punctuation(List):
         parse("/", cls)
         parse("?", cls)
         parse("|", cls)
+        parse("----", cls)
+        parse("...==>", cls)
+        parse("!!", cls)
+        if Parser().parse("*.:-~", cls)[0] != "-~":
+            raise BaseException(cls.__name__)
 
         # What should not work
         testFail("||", cls)
@@ -79,6 +373,7 @@ class LeadingSpaces(List):
     PyPeg, however, just pitches them, so we preprocess the code and encode
     the number of leading spaces.  This captures that encoding
     """
+    leadCharacters = "@"
     grammar = contiguous(
         "@INDENT-",
         attr("depth", re.compile(r"\d+")),
@@ -135,6 +430,7 @@ class InlineComment(List):
 
     TODO: Investigate putting inline comments in the YAML parts of the files.
     """
+    leadCharacters = "/"
     grammar = contiguous(
         "/*",
         attr("comment", re.compile(r".*?(?=\*/|\n)")),
@@ -149,11 +445,11 @@ class InlineComment(List):
         """
         return("")
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         For now use same as Markdown.
         """
-        return(compose(self))
+        return(compose(self, parser))
 
 
                 
@@ -176,6 +472,7 @@ class Comment(List):
     Given that PyPeg strips leading whitespace, I'm not sure how to tell when
     lines start with ##.
     """
+    leadCharacters = "#"
     grammar = contiguous(
         "##",
         optional(re.compile(r" *"),
@@ -192,11 +489,11 @@ class Comment(List):
         """
         return("")
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         For now use same as Markdown.
         """
-        return(compose(self))
+        return(compose(self, parser))
 
 
     @classmethod
@@ -234,11 +531,11 @@ class PlainText(List):
         """
         return(self.text)
         
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         For now use same as Markdown.
         """
-        return(compose(self))
+        return(compose(self, parser))
 
     def justTheString(self):
         """
@@ -309,6 +606,7 @@ class SuperScriptText(List):
 
     Note, there are no subscripts in Galaxy wiki.
     """
+    leadCharacters = "^"
     grammar = contiguous(
         attr("superText",
              re.compile(r"""\^(?P<supText>.+?)\^""")))
@@ -321,8 +619,8 @@ class SuperScriptText(List):
         return("<sup>" + self.superText[1:-1] + "</sup>")      # trim the ^
 
 
-    def composeHtml(self):
-        return(compose(self))             # same.
+    def composeHtml(self, parser):
+        return(compose(self, parser))     # same.
         
     @classmethod
     def test(cls):
@@ -339,6 +637,7 @@ class StrikeThroughText(List):
 
     Expectation is that this will not span across lines.
     """
+    leadCharacters = "-"
     grammar = contiguous(
         attr("strikeThroughText",
              re.compile(r"""--\(.+?\)--""")))
@@ -351,7 +650,7 @@ class StrikeThroughText(List):
         return("~~" + self.strikeThroughText[3:-3] + "~~")    # trim the --( )--
 
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         return("<s>" + self.strikeThroughText[3:-3] + "</s>") # trim the --( )--
         
     @classmethod
@@ -368,30 +667,20 @@ class Underline(List):
     __ 2 underscores start and end underlines in moinmoin
     """
     grammar = contiguous("__")
-    inUnderline = False
 
     def compose(self, parser, attr_of):
         """
         Markdown does not support underline.  
         """
-        return(self.composeHtml())
+        return(self.composeHtml(parser))
 
-    def composeHtml(self):
-        Underline.inUnderline = not Underline.inUnderline
-        if Underline.inUnderline:
+    def composeHtml(self, parser):
+        parser.context.inUnderline = not parser.context.inUnderline
+        if parser.context.inUnderline:
             return("<u>")                 # TODO: figure out what to do here.
         else:
             return("</u>")
 
-    @classmethod
-    def reset(cls):
-        if Underline.inUnderline:
-            print("Warning: Underline.inUnderline not restored to correct value, = " + 
-                  str(Underline.inUnderline))
-
-        Underline.inUnderline = False
-
-        
     @classmethod
     def test(cls):
         """
@@ -406,8 +695,8 @@ class Bold(List):
     """
     3 single quotes start and end bold in moinmoin
     """
+    leadCharacters = "'"
     grammar = contiguous("'''")
-    inBold = False
 
     def compose(self, parser, attr_of):
         """
@@ -415,22 +704,13 @@ class Bold(List):
         """
         return("**")
 
-    def composeHtml(self):
-        Bold.inBold = not Bold.inBold
-        if Bold.inBold:
+    def composeHtml(self, parser):
+        parser.context.inBold = not parser.context.inBold
+        if parser.context.inBold:
             return("<strong>")
         else:
             return("</strong>")
 
-    @classmethod
-    def reset(cls):
-        if Bold.inBold:
-            print("Warning: Bold.inBold not restored to correct value, = " + 
-                  str(Bold.inBold))
-
-        Bold.inBold = False
-
-        
     @classmethod
     def test(cls):
         """
@@ -446,8 +726,8 @@ class Italic(List):
 
     This must be processed after Bold.
     """
+    leadCharacters = "'"
     grammar = contiguous("''")
-    inItalic = False
 
     def compose(self, parser, attr_of):
         """
@@ -456,22 +736,13 @@ class Italic(List):
         return("*")
 
 
-    def composeHtml(self):
-        Italic.inItalic = not Italic.inItalic
-        if Italic.inItalic:
+    def composeHtml(self, parser):
+        parser.context.inItalic = not parser.context.inItalic
+        if parser.context.inItalic:
             return("<em>")
         else:
             return("</em>")
 
-    @classmethod
-    def reset(cls):
-        if Italic.inItalic:
-            print("Warning: Italic.inItalic not restored to correct value, = " + 
-                  str(Italic.inItalic))
-
-        Italic.inItalic = False
-
-                
     @classmethod
     def test(cls):
         """
@@ -489,6 +760,7 @@ class FontSizeChangeStart(List):
     Note: When viewing this in Github, the font doesn't actually change size,
     even though the HTML is correct.
     """
+    leadCharacters = "~"
     grammar = contiguous("~", attr("direction", re.compile("\+|\-")))
 
     def compose(self, parser, attr_of):
@@ -498,8 +770,8 @@ class FontSizeChangeStart(List):
             newSize = "smaller"
         return('<span style="font-size: ' + newSize + ';">')
         
-    def composeHtml(self):
-        return(compose(self))
+    def composeHtml(self, parser):
+        return(compose(self, parser))
         
     @classmethod
     def test(cls):
@@ -514,13 +786,14 @@ class FontSizeChangeEnd(List):
     """
     +~ / -~ finishes a change in font size
     """
+    leadCharacters = "+-"
     grammar = contiguous(re.compile("\+|\-"), "~")
 
     def compose(self, parser, attr_of):
         return('</span>')
         
-    def composeHtml(self):
-        return(compose(self))
+    def composeHtml(self, parser):
+        return(compose(self, parser))
         
     @classmethod
     def test(cls):
@@ -538,6 +811,7 @@ class Monospace(List):
     Can occur anywhwere that plain text can, and in Moin, markup inside monospace
     is rendered as plain text.
     """
+    leadCharacters = "{`"
     grammar = contiguous(
         re.compile(r"{{{|\`"),
         attr("monoText", re.compile(r".*?(?=}}}|\`)")),
@@ -547,7 +821,7 @@ class Monospace(List):
         return("`" + self.monoText + "`")
 
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         return("<code>" + self.monoText + "</code>")
 
                 
@@ -573,8 +847,10 @@ class CodeBlockStart(List):
     {{{
     #!highlight python
 
+    Most code blocks are a CodeBlock; this is only used for a {{{ that is
+    never ended, and the text after it is parsed as usual.
     """
-    inCodeBlock = False
+    leadCharacters = "{"
     grammar = contiguous(
         "{{{",
         optional(maybe_some(whitespace),
@@ -586,29 +862,20 @@ class CodeBlockStart(List):
         """
         Override compose method to generate Markdown.
         """
-        CodeBlockStart.inCodeBlock = True
+        parser.context.inCodeBlock = True
         out = "```"
         if hasattr(self, "format"):
             out += self.format
         return(out)
 
 
-    def composeHtml(self):
-        CodeBlockStart.inCodeBlock = True
+    def composeHtml(self, parser):
+        parser.context.inCodeBlock = True
         out = '<span class="codespan">'
         # IGNORING FORMAT; nothing we can do.
         return(out)
         
 
-    @classmethod
-    def reset(cls):
-        if CodeBlockStart.inCodeBlock:
-            print("Warning: CodeBlockStart.inCodeBlock not restored to correct value, = " + 
-                  str(CodeBlockStart.inCodeBlock))
-
-        CodeBlockStart.inCodeBlock = False
-
-
     @classmethod
     def test(cls):
         """
@@ -623,17 +890,18 @@ class CodeBlockEnd(List):
     """
     }}} ends a code block.
     """
+    leadCharacters = "}"
     grammar = contiguous("}}}")
 
     def compose(self, parser, attr_of):
         """
         Override compose method to generate Markdown.
         """
-        CodeBlockStart.inCodeBlock = False
+        parser.context.inCodeBlock = False
         return("```\n")
         
-    def composeHtml(self):
-        CodeBlockStart.inCodeBlock = False
+    def composeHtml(self, parser):
+        parser.context.inCodeBlock = False
         out = '<\span>'
         return(out)
 
@@ -645,7 +913,81 @@ class CodeBlockEnd(List):
         """
         parse("}}}", cls)
 
-        
+
+class CodeBlock(List):
+    """
+    A whole code block, from {{{ to }}}, that takes more than one line.
+
+    Nothing in a code block is markup, so rather than parse what's in it, we
+    scan ahead to the }}} that ends it, counting any {{{ }}} pairs in the
+    code, and keep everything in between as is.  {{{ }}} on one line is left
+    to Monospace, and a {{{ that is never ended is left to CodeBlockStart.
+    """
+    leadCharacters = "{"
+    # Same as CodeBlockStart's grammar
+    start = re.compile(r"\{\{\{(?:\s*#!(?:highlight(?:er)* +)?(?P<format>[^\s/]+))?")
+    braces = re.compile(r"\{\{\{|\}\}\}")
+
+    @classmethod
+    def parse(cls, parser, text, pos):
+        start = cls.start.match(text)
+        if start:
+            depth = 1
+            for brace in cls.braces.finditer(text, start.end()):
+                if brace.group(0) == "{{{":
+                    depth += 1
+                    continue
+                depth -= 1
+                if depth == 0:
+                    if "\n" not in text[:brace.start()]:
+                        break             # all on one line
+                    codeBlock = cls()
+                    if start.group("format"):
+                        codeBlock.format = start.group("format")
+                    codeBlock.code = text[start.end():brace.start()]
+                    return(text[brace.end():], codeBlock)
+        return(text, parser.generate_syntax_error("expecting a code block", pos))
+
+    def compose(self, parser, attr_of):
+        """
+        Override compose method to generate Markdown.
+        """
+        out = "```"
+        if hasattr(self, "format"):
+            out += self.format
+        return(out + restoreIndents(self.code) + "```\n")
+
+    def composeInList(self, parser, moinIndent, mdIndent):
+        """
+        Compose a code block that starts in a list item, so that it stays in
+        the item: its lines lose the item's moinIndent and get the item's
+        mdIndent instead.
+        """
+        lines = compose(self, parser).split("\n")
+        for lineIdx in range(1, len(lines) - 1):   # the last is after the closing ```
+            line = lines[lineIdx]
+            nSpaces = len(line) - len(line.lstrip(" "))
+            lines[lineIdx] = " " * mdIndent + line[min(nSpaces, moinIndent):]
+        return("\n".join(lines))
+
+    def composeHtml(self, parser):
+        # IGNORING FORMAT; nothing we can do.
+        return('<span class="codespan">' + restoreIndents(self.code) + '<\\span>')
+
+    @classmethod
+    def test(cls):
+        """
+        Test different instances of what this should and should not recognize
+        """
+        parse("{{{\ncode\n}}}", cls)
+        parse("{{{#!highlight ini\n[x]\n}}}", cls)
+        parse("{{{\n#!highlight python\nprint('{{{x}}}')\n}}}", cls)
+        testFail("{{{code}}}", cls)
+        testFail("{{{\ncode\n", cls)
+        if compose(parse("{{{#!highlight python\n@INDENT-4@''x''\n}}}", cls)) != (
+                "```python\n    ''x''\n```\n"):
+            raise BaseException(cls.__name__)
+
 
 
 # -------------
@@ -687,8 +1029,7 @@ class InternalPagePath(List):
                  attr("anchorPart", re.compile(r".+?(?=]]|\||$)"))))
 
     def compose(self, parser, attr_of):
-        global pageDepth
-        out = self.getWikiRootPath() + "/index.md"    
+        out = self.getWikiRootPath(parser.context) + "/index.md"    
 
         # Now the anchors; GitHub and Moin handle anchor links differently
         # See https://gist.github.com/asabaylus/3071099
@@ -739,13 +1080,11 @@ class InternalPagePath(List):
         return(False)
 
 
-    def getWikiRootPath(self):
+    def getWikiRootPath(self, context):
         """
         Convert a moin path to an MD path rooted in at the base of MD tree
         """
-        global wikiRoot
-        global wikiRootParts
-        wikiRootPath = wikiRoot
+        wikiRootPath = context.wikiRoot
         # Handle PagePath first
         if hasattr(self, "pagePart"):
             # invert from Moin to GFM.
@@ -757,9 +1096,9 @@ class InternalPagePath(List):
                 # Each ../ takes a part off the wiki root path
                 peelBack = (self.pagePart.count("../") * -1) + 1
                 if peelBack != 0:
-                    peeledBackRoot = "/" + "/".join(wikiRootParts[0:peelBack])
+                    peeledBackRoot = "/" + "/".join(context.wikiRootParts[0:peelBack])
                 else:
-                    peeledBackRoot = wikiRoot
+                    peeledBackRoot = context.wikiRoot
                 wikiRootPath = peeledBackRoot + "/" + self.pagePart.replace("../", "")
 
             elif self.isRootRelativeLink():
@@ -768,7 +1107,7 @@ class InternalPagePath(List):
                 # and, pagedepth is always one greater in MD, becuase every page in 
                 # in Moin is it's own subdirectory in Markdown
                 # TREMENDOUS HACK.
-                wikiRootPath = "/" + wikiRootParts[0] + "/" + self.pagePart
+                wikiRootPath = "/" + context.wikiRootParts[0] + "/" + self.pagePart
 
         return(wikiRootPath)
  
@@ -836,6 +1175,7 @@ class WikiWord(InternalPagePath):
     Can't end in a /, but can start with and have embedded /'s, 
     and all parts of path have to be WikiWords.
     """
+    leadCharacters = "/ABCDEFGHIJKLMNOPQRSTUVWXYZ"
     grammar = contiguous(
         attr("pagePart", re.compile(r"(/?[A-Z][a-z0-9]+([A-Z][a-z0-9]+)+)+")))
 
@@ -843,14 +1183,14 @@ class WikiWord(InternalPagePath):
         """
         WikiWords become links
         """
-        if CodeBlockStart.inCodeBlock:
+        if parser.context.inCodeBlock:
             out = self.getPagePart() 
         else:
-            out = "[" + self.getPagePart() + "](" + self.getWikiRootPath() + "/index.md)"
+            out = "[" + self.getPagePart() + "](" + self.getWikiRootPath(parser.context) + "/index.md)"
         return(out)
 
-    def composeHtml(self):
-        return('<a href="' + self.getWikiRootPath() + '/index.md">' + self.getPagePart() + '</a>')
+    def composeHtml(self, parser):
+        return('<a href="' + self.getWikiRootPath(parser.context) + '/index.md">' + self.getPagePart() + '</a>')
 
     @classmethod
     def test(cls):
@@ -888,6 +1228,7 @@ class SuppressedWikiWord(List):
       !WordsOfWisdon
 
     """
+    leadCharacters = "!"
     grammar = contiguous(
         "!",
         attr("wikiWord", WikiWord))
@@ -898,7 +1239,7 @@ class SuppressedWikiWord(List):
         """
         return(self.wikiWord.getPagePart())
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         return(self.wikiWord.getPagePart())
 
     @classmethod
@@ -953,8 +1294,7 @@ class InternalImagePath(List):
                       re.compile(r"[\w\-\.~:/?@!\$&'\*+;= %]+?\.(jpg|jpeg|JPG|JPEG|gif|GIF|png|PNG)")))
 
     def compose(self, parser, attr_of):
-        global pageDepth
-        out = self.getWikiRootPath()
+        out = self.getWikiRootPath(parser.context)
 
         return(out)
 
@@ -998,13 +1338,11 @@ class InternalImagePath(List):
         return(False)
 
 
-    def getWikiRootPath(self):
+    def getWikiRootPath(self, context):
         """
         Convert a moin path to an MD path rooted in at the base of MD tree
         """
-        global wikiRoot
-        global wikiRootParts
-        wikiRootPath = wikiRoot
+        wikiRootPath = context.wikiRoot
 
         if self.isLocalPageLink():
             # looks like Utah.png in moin
@@ -1017,15 +1355,15 @@ class InternalImagePath(List):
             # Each ../ takes a part off the wiki root path
             peelBack = (self.imagePath.count("../") * -1) + 1
             if peelBack != 0:
-                peeledBackRoot = "/" + "/".join(wikiRootParts[0:peelBack])
+                peeledBackRoot = "/" + "/".join(context.wikiRootParts[0:peelBack])
             else:
-                peeledBackRoot = wikiRoot
+                peeledBackRoot = context.wikiRoot
             wikiRootPath = peeledBackRoot + "/" + self.imagePath.replace("../", "")
 
         elif self.isRootRelativeLink():
             # Looks like Images/Utah.png in moin
             # TREMENDOUS HACK.
-            wikiRootPath = "/" + wikiRootParts[0] + "/" + self.imagePath
+            wikiRootPath = "/" + context.wikiRootParts[0] + "/" + self.imagePath
 
         return(wikiRootPath)
  
@@ -1077,13 +1415,13 @@ class InternalImage(List):
         # attachments seem to follow different rules than other paths.
         # An attachment with no path is in the local directory, instead of relative to the root.
         
-        out += "(" + self.imagePath.getWikiRootPath() + ")"
+        out += "(" + self.imagePath.getWikiRootPath(parser.context) + ")"
         return(out)
 
         
-    def composeHtml(self):
+    def composeHtml(self, parser):
         # Generate HTML img link as it can deal with sizes
-        out = '<img src="' + self.imagePath.getWikiRootPath() + '"'
+        out = '<img src="' + self.imagePath.getWikiRootPath(parser.context) + '"'
         
         # Add alt text
         if hasattr(self, "altText"):
@@ -1225,9 +1563,9 @@ class IncludeMacro(List):
         Override compose method to generate Markdown.
         """
         self.pagePath.inInclude = True
-        out = "PLACEHOLDER_INCLUDE(" + compose(self.pagePath)
+        out = "PLACEHOLDER_INCLUDE(" + compose(self.pagePath, parser)
         if self.params:
-            out += compose(self.params) 
+            out += compose(self.params, parser) 
         out += ")"
         return(out)
 
@@ -1346,12 +1684,10 @@ class TOCMacro(List):
         """
         Override compose method to generate Markdown.
         """
-        global pageYaml
-
         # No markdown to generate. It all goes in YAML.
         # MaxDepth not supported in YAML.
         
-        pageYaml["autotoc"] = "true"
+        parser.context.pageYaml["autotoc"] = "true"
         
         return("")
 
@@ -1421,7 +1757,7 @@ class MailToMacro(List):
         out += "[mailto:" + self.emailAddress + "]"
         return(out)
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         out = '<a href="mailto:' + self.emailAddress + '">'
         if hasattr(self, "toText"):
             out += self.toText
@@ -1573,6 +1909,7 @@ class Macro(List):
       <<Include(/Includes, , from="= LAPTOP WITH =\n", to="\nEND_INCLUDE")>>
       TODO
     """
+    leadCharacters = "<"
     grammar = contiguous(
         "<<",
         attr("macro",
@@ -1583,18 +1920,18 @@ class Macro(List):
 
 
     def compose(self, parser, attr_of):
-        return(compose(self.macro))
+        return(compose(self.macro, parser))
     
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         For cases when the subelement needs to be rendered in HTML (such as
         inside a table).
         """
         # for most macros, default to same markup as used in Markdown.
         if isinstance(self.macro, MailToMacro):
-            return(self.macro.composeHtml())
+            return(self.macro.composeHtml(parser))
         else:
-            return(compose(self.macro))
+            return(compose(self.macro, parser))
 
     @classmethod
     def test(cls):
@@ -1633,6 +1970,7 @@ class SectionHeader(List):
     That must be the only thing on the line.  Moin does not like leading or
     trailing spaces.
     """        
+    leadCharacters = "="
     grammar = contiguous(
         attr("depth", re.compile(r"^=+")),
         re.compile(" +"),
@@ -1704,7 +2042,7 @@ class TextToEndOfLinkClause(List):
     def compose(self, parser, attr_of):
         return(self.textToEndOfLinkClause)
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         # no different
         return(self.textToEndOfLinkClause)
 
@@ -1766,18 +2104,18 @@ class AttachmentLink(List):
 
         if hasattr(self, "linkDisplay") and hasattr(self.linkDisplay, "imagePath"):
             # item shown for link is an image; must be rendered in html
-            out = self.composeHtml()
+            out = self.composeHtml(parser)
         else:
             # item shown for link is text; can be in markdown
             if hasattr(self.attachedItem, "getPagePart"): # HACK
                 # thing we are linking to is a document
-                link = "PLACEHOLDER_ATTACHMENT_URL" + self.attachedItem.getWikiRootPath()
+                link = "PLACEHOLDER_ATTACHMENT_URL" + self.attachedItem.getWikiRootPath(parser.context)
             else:
                 # thing we are linking to is an image.
-                link = self.attachedItem.getWikiRootPath()
+                link = self.attachedItem.getWikiRootPath(parser.context)
 
             if hasattr(self, "linkDisplay"):
-                linkText = compose(self.linkDisplay)
+                linkText = compose(self.linkDisplay, parser)
             else:
                 linkText = link
             out = "[" + linkText + "](" + link + ")"
@@ -1785,15 +2123,15 @@ class AttachmentLink(List):
         return(out)
 
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         if hasattr(self.attachedItem, "getPagePart"):
-            linkText =  self.attachedItem.getWikiRootPath()
+            linkText =  self.attachedItem.getWikiRootPath(parser.context)
             link = "PLACEHOLDER_ATTACHMENT_URL" + linkText
         else:
-            link = self.attachedItem.getWikiRootPath()
+            link = self.attachedItem.getWikiRootPath(parser.context)
             linkText = link
         if hasattr(self, "linkDisplay"):
-            out = "<a href='" + link + "'>" + (self.linkDisplay.composeHtml()) + '</a>'
+            out = "<a href='" + link + "'>" + (self.linkDisplay.composeHtml(parser)) + '</a>'
         else:
             out = "<a href='" + link + "'>" + linkText + '</a>'
 
@@ -1848,22 +2186,22 @@ class InternalLink(List):
         # TODO: Nothing is done with the extras.
 
         try:
-            out = "[" + self.linkText + "](" + compose(self.path) + ")"
+            out = "[" + self.linkText + "](" + compose(self.path, parser) + ")"
         except AttributeError:
             # link is just the page name.  Can't use path in displayed text because of
             # added ../
-            out = "[" +  self.path.getPagePart() + "](" + compose(self.path) + ")" 
+            out = "[" +  self.path.getPagePart() + "](" + compose(self.path, parser) + ")" 
         return(out)
 
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         # Try with link text first
         try:
-            out = "<a href='" + compose(self.path) + "'>" + self.linkText + "</a>"
+            out = "<a href='" + compose(self.path, parser) + "'>" + self.linkText + "</a>"
         except AttributeError:
             # err on the safe side
             out = ("<a href='" + self.path.getPagePart() + "'>" +
-                   compose(self.path) + "</a>")
+                   compose(self.path, parser) + "</a>")
         return(out)
 
         
@@ -2011,13 +2349,13 @@ class InterWikiLink(List):
         return(out)
 
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         global interWikiMap
         
         if self.interWikiName.lower() == "mailto":
             # build a MailToMacro object
             self.createMailToMacro()
-            out = self.m2m.composeHtml()
+            out = self.m2m.composeHtml(parser)
         else:
             url = interWikiMap[self.interWikiName.lower()].url
             if hasattr(self, 'wikiPage'):
@@ -2069,19 +2407,19 @@ class ExternalImage(List):
         Use Markdown image notation
         """
         if self.needsHtmlRendering():
-            out = self.composeHtml()
+            out = self.composeHtml(parser)
         else:
             out = "!["
             if hasattr(self, "altText"):
                 out += self.altText
-            out += "](" + compose(self.protocol) + compose(self.path) + ")"
+            out += "](" + compose(self.protocol, parser) + compose(self.path, parser) + ")"
                     
         return(out)
 
         
-    def composeHtml(self):
+    def composeHtml(self, parser):
         # Generate HTML img link as it can deal with sizes
-        out = '<img src="' + compose(self.protocol) + compose(self.path) + '"'
+        out = '<img src="' + compose(self.protocol, parser) + compose(self.path, parser) + '"'
         
         # Add alt text
         if hasattr(self, "altText"):
@@ -2127,20 +2465,21 @@ class Image(List):
 
     Many images include sizing, and that is not supported in Markdown.
     """
+    leadCharacters = "{"
     grammar = contiguous(
         attr("image", [InternalImage, ExternalImage]))
 
     def compose(self, parser, attr_of):
         if self.needsHtmlRendering():
-            out = self.composeHtml()
+            out = self.composeHtml(parser)
         else:
-            out = compose(self.image)
+            out = compose(self.image, parser)
         return(out)
 
         
-    def composeHtml(self):
+    def composeHtml(self, parser):
         # Generate HTML img link as it can deal with sizes
-        out = self.image.composeHtml()                    
+        out = self.image.composeHtml(parser)                    
         return(out)
 
 
@@ -2203,12 +2542,12 @@ class ImageLink(List):
         # Generate HTML img link as it can deal with alt txt and sizes
         out = "<a href='"
         try:
-            out += compose(self.protocol)
+            out += compose(self.protocol, parser)
         except AttributeError:
             pass
         
-        out += compose(self.linkPath) + "'>"
-        out += self.image.composeHtml()
+        out += compose(self.linkPath, parser) + "'>"
+        out += self.image.composeHtml(parser)
         # TODO: figure out when imageLinks can be in GFM.
         out += "</a>"
                     
@@ -2216,11 +2555,11 @@ class ImageLink(List):
             
         
         
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         Same markup is generated for Markdown and HTML cases.
         """
-        return(compose(self))
+        return(compose(self, parser))
 
 
 
@@ -2260,21 +2599,21 @@ class ExternalLink(List):
         """
         Override compose method to generate Markdown.
         """
-        linkOut = compose(self.protocol) + compose(self.path)
+        linkOut = compose(self.protocol, parser) + compose(self.path, parser)
         # Not currently rendering theRest.  The rest is usually target or moin-specific.
         # We can live without both. 
         if hasattr(self, "linkText"):
-            out = "[" + compose(self.linkText) + "](" + linkOut + ")"
+            out = "[" + compose(self.linkText, parser) + "](" + linkOut + ")"
         else:
             out = "[" + linkOut + "](" + linkOut + ")" 
         return(out)
 
 
-    def composeHtml(self):
-        linkOut = compose(self.protocol) + compose(self.path)
+    def composeHtml(self, parser):
+        linkOut = compose(self.protocol, parser) + compose(self.path, parser)
         # TODO: Not currently rendering theRest.
         if hasattr(self, "linkText"):
-            out = "<a href='" + linkOut + "'>" + compose(self.linkText) + "</a>"
+            out = "<a href='" + linkOut + "'>" + compose(self.linkText, parser) + "</a>"
         else:
             out = "<a href='" + linkOut + "'>" + linkOut + "</a>"
         return(out)
@@ -2324,11 +2663,11 @@ class DirectExternalLink(List):
         """
         Override compose method to generate Markdown.
         """
-        return(compose(self.protocol) + compose(self.path))
+        return(compose(self.protocol, parser) + compose(self.path, parser))
 
 
-    def composeHtml(self):
-        linkOut = compose(self.protocol) + compose(self.path)
+    def composeHtml(self, parser):
+        linkOut = compose(self.protocol, parser) + compose(self.path, parser)
         out = "<a href='" + linkOut + "'>" + linkOut + "</a>"
         return(out)
         
@@ -2354,6 +2693,7 @@ class Link(List):
     Links in Moin are enclosed in [[ ]].  Some have text, some have embedded
     images, and some have extra params.
     """
+    leadCharacters = "[hHfFrR"             # [[ or the start of a LinkProtocol
     grammar = contiguous(
         attr("link", [AttachmentLink, ImageLink, ExternalLink, DirectExternalLink, 
                       InterWikiLink, InternalLink]))
@@ -2363,15 +2703,15 @@ class Link(List):
         """
         Override compose method to generate Markdown.
         """
-        return(compose(self.link))
+        return(compose(self.link, parser))
 
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         For cases when the subelement needs to be rendered in HTML (such as
         inside a table).
         """
-        return(self.link.composeHtml())
+        return(self.link.composeHtml(parser))
 
         
     @classmethod
@@ -2409,10 +2749,13 @@ class Subelement(List):
          SuperScriptText, StrikeThroughText,
          # Underline, 
          Bold, Italic, Monospace,
-         CodeBlockStart, CodeBlockEnd,
+         CodeBlock, CodeBlockStart, CodeBlockEnd,
          FontSizeChangeStart, FontSizeChangeEnd,
          InlineComment, PlainText, Punctuation])
 
+    @classmethod
+    def parse(cls, parser, text, pos):
+        return(dispatchParse(cls, parser, text, pos))
     
     def compose(self, parser, attr_of):
         """
@@ -2420,18 +2763,18 @@ class Subelement(List):
         """
         out = ""
         for item in self:
-            out += compose(item)
+            out += compose(item, parser)
         return(out)
 
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         For cases when the subelement needs to be rendered in HTML (such as
         inside a table).
         """
         out = ""
         for item in self:
-            out += item.composeHtml()
+            out += item.composeHtml(parser)
         return(out)
         
 
@@ -2464,7 +2807,7 @@ class SubelementSansMacro(Subelement):
          SuperScriptText, StrikeThroughText,
          # Underline, 
          Bold, Italic, Monospace,
-         CodeBlockStart, CodeBlockEnd,
+         CodeBlock, CodeBlockStart, CodeBlockEnd,
          FontSizeChangeStart, FontSizeChangeEnd,
          InlineComment, PlainText, Punctuation])
 
@@ -2474,7 +2817,7 @@ class SubelementSansMacro(Subelement):
         """
         out = ""
         for item in self:
-            out += compose(item)
+            out += compose(item, parser)
         return(out)
 
 
@@ -2512,13 +2855,17 @@ class MoinListItem(List):
         
         See Events/GCC2014/TrainingDay/DataManagers for test case.
         """
-        out = " " * MoinList.indentLevel * 2
+        out = " " * parser.context.listIndentLevel * 2
         if hasattr(self, "itemMarker"):
             out += self.itemMarker + " "
         else:
             out += "  "
         for subelement in self.item:
-            out += compose(subelement)
+            if isinstance(subelement[0], CodeBlock):
+                out += subelement[0].composeInList(
+                    parser, int(self.depth.depth), parser.context.listIndentLevel * 2 + 2)
+            else:
+                out += compose(subelement, parser)
         out += "\n"
         return(out)
 
@@ -2548,37 +2895,27 @@ class MoinList(List):
           
     at varying levels of indent
     """
+    leadCharacters = "@"
     grammar = contiguous(
         re.compile(r"(?=@INDENT-\d+@(\*|\d+\.))"),  # 1st item must be list item
         attr("listItems", some(MoinListItem)),
         maybe_some(re.compile(r" *\n")))
-    indentLevel = 0
-    indentBase = 0
 
     def compose(self, parser, attr_of):
         depths = [int(self.listItems[0].depth.depth)] 
         out = ""
         for item in self.listItems:
-            if CodeBlockStart.inCodeBlock and MoinList.indentBase == 0:
-                MoinList.indentBase = MoinList.indentLevel
-            elif not CodeBlockStart.inCodeBlock and MoinList.indentBase != 0:
-                MoinList.indentBase = 0 # we are out
-            MoinList.indentLevel = LeadingSpaces.trackIndent(
-                item, depths, MoinList.indentBase)
-            out += compose(item)
+            context = parser.context
+            if context.inCodeBlock and context.listIndentBase == 0:
+                context.listIndentBase = context.listIndentLevel
+            elif not context.inCodeBlock and context.listIndentBase != 0:
+                context.listIndentBase = 0 # we are out
+            context.listIndentLevel = LeadingSpaces.trackIndent(
+                item, depths, context.listIndentBase)
+            out += compose(item, parser)
         out += "\n"             # have to have a trailing blank line.
         return(out)
 
-    @classmethod
-    def reset(cls):
-        # indentLevel can end up at 0 or 1, so don't report on it.
-        if MoinList.indentBase:
-            print("Warning: MoinList.indentBase not restored to correct value, = " + 
-                  str(MoinList.indentBase))
-
-        MoinList.indentLevel = 0
-        MoinList.indentBase = 0
-    
     @classmethod
     def test(cls):
         """
@@ -2668,16 +3005,16 @@ class CellMoinFormatItem(List):
         elif hasattr(self, "bottom"):
             return("PLACEHOLDER_BOTTOM")
         elif hasattr(self, "cellStyle"):
-            return("PLACEHOLDER_STYLE=" + compose(self.cellStyle))
+            return("PLACEHOLDER_STYLE=" + compose(self.cellStyle, parser))
         elif hasattr(self, "bgcolor"):
-            return("PLACEHOLDER_BGCOLOR=" + compose(self.bgcolor))
+            return("PLACEHOLDER_BGCOLOR=" + compose(self.bgcolor, parser))
         elif hasattr(self, "width"):
-            return("PLACEHOLDER_WIDTH=" + compose(self.width))
+            return("PLACEHOLDER_WIDTH=" + compose(self.width, parser))
         elif hasattr(self, "unquotedWidth"):
             return("PLACEHOLDER_WIDTH=" + self.unquotedWidth)
         return("UNRECOGNOZED CELL FORMAT ITEM")
 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         render CellMoinFormatItems as HTML.
 
@@ -2745,7 +3082,7 @@ class CellClass(List):
         "class=", attr("cellClass", QuotedString))     
 
     def compose(self, parser, attr_of):
-        return("class=" + compose(self.cellClass))
+        return("class=" + compose(self.cellClass, parser))
 
     def isHeader(self):
         return(self.cellClass.justTheString().lower() == "th")
@@ -2782,13 +3119,13 @@ class TableCell(List):
         out = "" 
         try:
             for item in self.cellFormat:
-                out += compose(item)
+                out += compose(item, parser)
         except AttributeError:
             pass
 
         try:
             for item in self.cellContent:
-                out += compose(item)
+                out += compose(item, parser)
         except AttributeError:
             pass
         return(out + " |")
@@ -2818,7 +3155,7 @@ class RowStyle(List):
         "rowstyle=", attr("rowStyle", QuotedString))     
 
     def compose(self, parser, attr_of):
-        return("ROWSTYLE=" + compose(self.rowStyle))
+        return("ROWSTYLE=" + compose(self.rowStyle, parser))
 
     @classmethod
     def test(cls):
@@ -2834,7 +3171,7 @@ class RowClass(List):
         "rowclass=", attr("rowClass", QuotedString))
 
     def compose(self, parser, attr_of):
-        return("ROWCLASS=" + compose(self.rowClass))
+        return("ROWCLASS=" + compose(self.rowClass, parser))
 
     def isHeader(self):
         return(self.rowClass.justTheString().lower() == "th")
@@ -2880,7 +3217,7 @@ class TableRow(List):
         """
         firstCellText = "| "
         for item in self.firstCellContent:
-            firstCellText += compose(item)
+            firstCellText += compose(item, parser)
         out = firstCellText + "| "
         if self.rowIsHeader():
             # header lines must have at least 3 hyphens to work.
@@ -2889,7 +3226,7 @@ class TableRow(List):
         for cell in self.rowCells:
             cellText = " "
             for item in cell.cellContent:
-                cellText += compose(item)
+                cellText += compose(item, parser)
             out += cellText + " | "
             if self.rowIsHeader():
                 headerOut += "-" * max(3, (len(cellText)-1)) + " | "
@@ -2966,17 +3303,18 @@ class Table(List):
     The first cell of the first row is also special, but only because only the
     first row can be special in GFM.
     """
+    leadCharacters = "|"
     grammar = contiguous(attr("tableRows", some(TableRow)))
 
     def compose(self, parser, attr_of):
 
         # Can this table be rendered in GFM, or does it need HTML?
         if self.needsHTMLRendering():
-            out = self.composeHtml()
+            out = self.composeHtml(parser)
         else:
             out = "\n"   # Tables have to start with a leading blank line in some (all?) circumstances
             for row in self.tableRows:
-                out += compose(row)
+                out += compose(row, parser)
             
         return(out)
 
@@ -3031,7 +3369,7 @@ class Table(List):
         return(True)                     # Does not require HTML
 
 
-    def composeCellHtml(self, row, cellClass, cellFormat, cellContent):
+    def composeCellHtml(self, row, cellClass, cellFormat, cellContent, parser):
         """
         compose a cell in HTML.
 
@@ -3049,10 +3387,10 @@ class Table(List):
         if row.rowIsHeader() or (cellClass != None and cellClass.isHeader()):
             cellType = "th"
         if cellClass != None and not cellClass.isHeader():
-            cellStyle += " class=" + compose(cellClass.cellClass) + " "
+            cellStyle += " class=" + compose(cellClass.cellClass, parser) + " "
         if cellFormat != None:
             for formatItem in cellFormat:
-                formatText, inStyle = formatItem.composeHtml()
+                formatText, inStyle = formatItem.composeHtml(parser)
                 if inStyle:
                     cellStyle += " " + formatText
                 else:
@@ -3063,7 +3401,7 @@ class Table(List):
 
         cellContentText = ""
         for item in cellContent:
-            cellContentText += item.composeHtml()
+            cellContentText += item.composeHtml(parser)
         cellHtml = (
             "    <" + cellType + cellAttribs + cellStyle + "> " +
             cellContentText + "</" + cellType + ">\n")
@@ -3071,7 +3409,7 @@ class Table(List):
 
 
                 
-    def composeHtml(self):
+    def composeHtml(self, parser):
         """
         Table contains markup that cannot be rendered in GFM.
         """
@@ -3095,7 +3433,7 @@ class Table(List):
             if hasattr(row, "firstCellFormat"):
                 cellFormat = row.firstCellFormat
             out += self.composeCellHtml(row, cellClass, cellFormat,
-                                        row.firstCellContent)
+                                        row.firstCellContent, parser)
             
             # render the rest of the cells
             for cell in row.rowCells:
@@ -3106,7 +3444,7 @@ class Table(List):
                 if hasattr(cell, "cellFormat"):
                     cellFormat = cell.cellFormat
                 out += self.composeCellHtml(row, cellClass, cellFormat,
-                                            cell.cellContent)
+                                            cell.cellContent, parser)
 
             # Render the end of the row
             out += "  </tr>\n"
@@ -3155,7 +3493,7 @@ class Paragraph(List):
     def compose(self, parser, attr_of):
         out = ""
         for item in self:
-            out += compose(item)
+            out += compose(item, parser)
         return(out)
 
     @classmethod
@@ -3189,14 +3527,12 @@ class TitleDiv(List):
         "<<div>>")
 
     def compose(self, parser, attr_of):
-        global pageYaml
-
         # Hack it.  Titles are inserting a spurious ", *, " around punctuation
         # Strip out those commas and spaces
-        pageTitle = compose(self.title)
+        pageTitle = compose(self.title, parser)
         pageTitle = re.sub(r", ", "", pageTitle)
 
-        pageYaml["title"] = pageTitle # TODO: can include markdown, probably won't like that
+        parser.context.pageYaml["title"] = pageTitle # TODO: can include markdown, probably won't like that
 
         # title in text generated from page title in YAML
         return('')
@@ -3218,6 +3554,7 @@ class YamlMacro(List):
     Anything parsed by this requires something other than just generating a
     markdown
     """
+    leadCharacters = "<"
     grammar = contiguous(TitleDiv)
 
 
@@ -3240,15 +3577,18 @@ class Element(List):
     """
     grammar = contiguous(
         [SectionHeader, YamlMacro, MoinList, Table, Macro,
-         CodeBlockStart, CodeBlockEnd, FontSizeChangeStart, FontSizeChangeEnd,
+         CodeBlock, CodeBlockStart, CodeBlockEnd, FontSizeChangeStart, FontSizeChangeEnd,
          Comment, Paragraph, TrailingWhitespace])
 
+    @classmethod
+    def parse(cls, parser, text, pos):
+        return(dispatchParse(cls, parser, text, pos))
 
     def compose(self, parser, attr_of):
         """
         Override compose method to generate Markdown.
         """
-        return(compose(self[0]))
+        return(compose(self[0], parser))
 
     @classmethod
     def test(cls):
@@ -3260,6 +3600,7 @@ class Element(List):
         YamlMacro.test()
         MoinList.test()
         Macro.test()
+        CodeBlock.test()
         CodeBlockStart.test()
         CodeBlockEnd.test()
         Comment.test()
@@ -3328,7 +3669,7 @@ class RedirectPI(List):
         attr("redirect", InternalPagePath))
 
     def compose(self, parser, attr_of):
-        raise NotImplementedError("Not generating REDIRECT Pages. Letting them die.")
+        raise NotImplementedError(UNTRANSLATED_PAGE_KINDS["redirect"])
 
     @classmethod
     def test(cls):
@@ -3353,7 +3694,7 @@ class RefreshPI(List):
         attr("redirect", restline))
 
     def compose(self, parser, attr_of):
-        raise NotImplementedError("Not generating refresh Pages. Letting them die.")
+        raise NotImplementedError(UNTRANSLATED_PAGE_KINDS["refresh"])
 
     @classmethod
     def test(cls):
@@ -3407,7 +3748,7 @@ class ProcessingInstruction(List):
 
     
     def compose(self, parser, attr_of):
-        return(compose(self.pi))
+        return(compose(self.pi, parser))
     
     @classmethod
     def test(cls):
@@ -3443,6 +3784,46 @@ class Document(List):
 """, cls)
 
 
+class DocumentBlock(List):
+    """
+    A block of a page after the first (see splitBlocks).  Only the start of
+    a page can have processing instructions.
+    """
+    grammar = contiguous(maybe_some(Element))
+
+
+class UnparsedBlock(str):
+    """
+    A block of a page that didn't parse (see parseBlocks).  It is passed
+    through as is, in a fenced code block marked PLACEHOLDER_UNPARSED, so
+    the rest of the page can still be translated, and someone can fix this
+    bit by hand.
+
+    The text is the preprocessed block; error is the SyntaxError it got.
+    """
+    error = None
+
+    def compose(self, parser, attr_of):
+        """
+        Override compose method to generate Markdown.
+        """
+        if self.error is not None:
+            parser.context.warnings.append(
+                "Block not parsed, passed through as is: " + str(self.error))
+        text = restoreIndents(str(self))
+        body = text.rstrip("\n")
+        # The fence has to be longer than any run of backticks in the block.
+        fence = "`" * max([3] + [len(run) + 1 for run in re.findall(r"`{3,}", body)])
+        return(fence + "PLACEHOLDER_UNPARSED\n" + body + "\n" + fence + "\n" +
+               text[len(body) + 1:])
+
+    @classmethod
+    def test(cls):
+        block = cls("@INDENT-1@* ```a\n\n")
+        if compose(block) != "````PLACEHOLDER_UNPARSED\n * ```a\n````\n\n":
+            raise BaseException(cls.__name__)
+
+
 
 # =================================
 # Non grammar subs
@@ -3463,13 +3844,39 @@ class Argghhs(object):
             help="File containing a single MoinMoin page.")
         argParser.add_argument(
             "--mdpage", required=False, default=None,
-            help="Where to put the resulting markdown page.")
+            help="Where to put the resulting markdown page.  Default is stdout.")
         argParser.add_argument(
             "--wikiroot", required=False, default="/src",
             help="Root of all links used inside the wiki. For example, /src.")
         argParser.add_argument(
-            "--pagedepth", required=False, default=0,
+            "--pagedepth", required=False, type=int, default=0,
             help="How deep in the directory structure is the page.  0 = top")
+        argParser.add_argument(
+            "--pagelist", required=False, default=None,
+            help="File listing MoinMoin pages to translate, one per line.  A line can also give the markdown page to write, after a tab.")
+        argParser.add_argument(
+            "--glob", required=False, default=None,
+            help="Translate every MoinMoin page matching this pattern, where ** matches any number of directories.  Quote it, so the shell doesn't expand it.")
+        argParser.add_argument(
+            "--manifest", required=False, default=None,
+            help='JSON-lines file of pages to translate, one {"moinpage": ..., "mdpage": ..., "wikiroot": ..., "pagedepth": ...} per line.  wikiroot and pagedepth default to --wikiroot and --pagedepth.')
+        argParser.add_argument(
+            "--mddir", required=False, default=None,
+            help="Where to put the markdown for --pagelist and --glob pages that don't say.  Pages keep their paths below the deepest directory all of them are in, with .moin replaced by .md.  Default is next to each MoinMoin page.")
+        argParser.add_argument(
+            "--jobs", required=False, type=int, default=1,
+            help="Number of processes to translate --pagelist, --glob and --manifest pages with.  Default is 1.")
+        argParser.add_argument(
+            "--blockjobs", required=False, type=int, default=1,
+            help="Number of processes to parse the blocks of a --moinpage with.  Default is 1.  Only worth it for very large pages.")
+        argParser.add_argument(
+            "--packrat", required=False,
+            help="Parse with a packrat memo keyed by position, and say how often it was used.",
+            action="store_true")
+        argParser.add_argument(
+            "--strict", required=False,
+            help="Fail a page if any of it doesn't parse.  By default, blocks that don't parse are passed through as they are, in a PLACEHOLDER_UNPARSED code block, with a warning.",
+            action="store_true")
         argParser.add_argument(
             "--runtests", required=False, 
             help="Run Unit Tests.",
@@ -3480,20 +3887,20 @@ class Argghhs(object):
             action="store_true")
         self.args = argParser.parse_args()
 
-        return(None)
+        batch = self.args.pagelist or self.args.glob or self.args.manifest
+        if batch and (self.args.moinpage or self.args.mdpage):
+            argParser.error("--moinpage and --mdpage can't be used with --pagelist, --glob or --manifest")
+        if self.args.mddir and not (self.args.pagelist or self.args.glob):
+            argParser.error("--mddir requires --pagelist or --glob")
+        if self.args.jobs < 1:
+            argParser.error("--jobs must be at least 1")
+        if self.args.blockjobs < 1:
+            argParser.error("--blockjobs must be at least 1")
+        if self.args.blockjobs > 1 and not self.args.moinpage:
+            argParser.error("--blockjobs only applies to --moinpage")
 
+        return(None)
 
-def resetState():
-    """
-    There are some state variables used in this module that should be restored to initial values
-    as input text is parsed.  However, sometimes the input text doesn't close a tag as it should.
-    So, we need to reset state.
-    """
-    Underline.reset()
-    Bold.reset()
-    Italic.reset()
-    CodeBlockStart.reset()
-    MoinList.reset()
 
 def testFail(testText, cls):
     """
@@ -3512,9 +3919,29 @@ def testFail(testText, cls):
     return()
 
 
-def insertIndentFlag(match):
-    indent = len(match.group('leading'))
-    return("@INDENT-" + str(indent) + "@") 
+# Characters replaced before parsing, and what they're replaced with.  Put
+# new normalisations here: NORMALISABLE finds all of them in one pass over
+# the page, however many there are.
+NORMALISATIONS = {
+    "\xa0": " "}                         # the mystery character (non breaking space)
+
+NORMALISABLE = re.compile("|".join(map(re.escape, NORMALISATIONS)))
+
+LEADING_SPACES = re.compile(r"^( +)(?=\S)", re.MULTILINE)
+
+
+class IndentFlags(dict):
+    """
+    The @INDENT-n@ flag for each run of leading spaces.  Each flag is only
+    made the first time that many spaces turn up.
+    """
+
+    def __missing__(self, leading):
+        flag = self[leading] = "@INDENT-" + str(len(leading)) + "@"
+        return(flag)
+
+indentFlags = IndentFlags()
+
 
 def identifyIndents(moinText):
     """
@@ -3522,10 +3949,220 @@ def identifyIndents(moinText):
     depth in lists, and when text should be indented.
     Resolve this by replacing leading spaces with a unique string that also
     identifies how much indent there is.
+
+    Splitting on the leading spaces puts them at every other place in the
+    list, so they can all be swapped for their flags without calling back
+    into Python for each line.
     """
-    return(re.sub(r"^(?P<leading> +)(?=\S)", insertIndentFlag, moinText,
+    pieces = LEADING_SPACES.split(moinText)
+    pieces[1::2] = map(indentFlags.__getitem__, pieces[1::2])
+    return("".join(pieces))
+
+
+def preprocess(moinText):
+    """
+    Get a page ready to parse, in one go: replace the characters in
+    NORMALISATIONS, then flag leading spaces (see identifyIndents).
+    """
+    moinText = NORMALISABLE.sub(lambda match: NORMALISATIONS[match.group(0)], moinText)
+    return(identifyIndents(moinText))
+
+def restoreIndents(moinText):
+    """
+    Put back the leading spaces identifyIndents took out, for text we pass
+    through as is.
+    """
+    return(re.sub(r"^@INDENT-(\d+)@", lambda match: " " * int(match.group(1)), moinText,
                   flags=re.MULTILINE))
 
+# Things that can carry on over a blank line, and so can't be cut in two: code
+# blocks, anything in double brackets, and title divs, whose <<div>> can be
+# on a later line.  A line ending in "<<div(" might be a title div too.
+BLOCK_TOKENS = re.compile(r"(?P<titleDiv><<div\(\s*(?:title|$))|(?P<divEnd><<div>>)|"
+                          r"(?P<open>\{\{\{|\[\[|\{\{|<<)|(?P<close>\}\}\}|\]\]|\}\}|>>)")
+
+LINES = re.compile(r"[^\n]*\n|[^\n]+")  # only \n ends a line; splitlines knows lots more
+
+# Anything that might be markup, or that translating might change.  A page
+# with none of these translates to itself (see isPlainPage).
+MARKUP = re.compile(
+    r"[^\w \t\n.,;:?!()\"%&$*'/\-]"      # every other character, including \r and non breaking spaces
+    r"|^[ \t]|\A\s"                       # indents, and whitespace at the start of the page
+    r"|''|--\(|![/A-Z]|/[*A-Z]|://"        # bold, italic, strike through, !WikiWord, /* comments, links
+    r"|[A-Z][a-z0-9]+[A-Z][a-z0-9]",       # WikiWords
+    re.MULTILINE)
+
+# Set to False to send plain pages through the parser like any other.
+plainPageFastPath = True
+
+
+def isPlainPage(moinText):
+    """
+    True if moinText has no markup at all: just words, some punctuation, and
+    lines.  Its translation is then the text itself, so it needn't be parsed.
+    """
+    return(not MARKUP.search(moinText))
+
+
+def lineKind(line):
+    """
+    What kind of block a (preprocessed) line would start.
+    """
+    if line.strip(" \t\f\v\n") == "":
+        return("blank")
+    elif line.startswith("="):
+        return("header")
+    elif line.startswith("||"):
+        return("table")
+    elif line.startswith("@INDENT-"):
+        return("list")
+    elif line.startswith("{{{"):
+        return("code")
+    return("text")
+
+
+def splitBlocks(moinText):
+    """
+    Cut preprocessed moinText into blocks that can be parsed separately:
+    headers, tables, list runs, code blocks and paragraphs.  Parsing the
+    blocks one at a time gives the same elements as parsing the whole page.
+
+    Cuts are only made at the start of a line where nothing is left open,
+    and where the line starts something new: after a blank line, or where
+    the kind of line changes.  Table rows and list items carry on the table
+    or list above them unless there is a blank line in between.  Blank lines
+    stay with the block above them.  Anything we aren't sure of stays in one
+    block; a page with a [[ that is never closed is one block from there on.
+
+    Returns a list of blocks that join back into moinText.
+    """
+    blocks = []
+    blockStart = 0
+    lineStart = 0
+    previousKind = None
+    depth = 0                             # open brackets (and code blocks)
+    inTitleDiv = False
+    blockHasText = False                  # whitespace at the start of a page is skipped as one
+    for line in LINES.findall(moinText):
+        kind = lineKind(line)
+        if (blockHasText and kind != "blank" and depth == 0 and
+            not inTitleDiv and (previousKind == "blank" or
+                                (kind != previousKind and kind not in ["table", "list"]))):
+            blocks.append(moinText[blockStart:lineStart])
+            blockStart = lineStart
+            blockHasText = False
+        if not line.isspace():
+            blockHasText = True
+        for token in BLOCK_TOKENS.finditer(line):
+            if token.group("titleDiv"):
+                inTitleDiv = True
+            elif token.group("divEnd"):
+                inTitleDiv = False
+            elif token.group("open"):
+                depth += 1
+            elif depth > 0:
+                depth -= 1
+        previousKind = kind
+        lineStart += len(line)
+    blocks.append(moinText[blockStart:])
+    return(blocks)
+
+
+def parseBlock(job):
+    """
+    Parse one block from splitBlocks.  job is [blockText, firstLine,
+    lastBlock, packrat], where firstLine is the line of the page the block
+    starts on, and lastBlock is true for the last block of the page.
+
+    Returns the parsed block and any packrat stats, or, if the block doesn't
+    parse, the SyntaxError, with the line number in the page rather than in
+    the block.
+    """
+    blockText, firstLine, lastBlock, packrat = job
+    if packrat:
+        parser = PackratParser()
+    else:
+        parser = Parser()
+    # pypeg2 skips whitespace at the start and end of the text it parses.
+    # That should only happen at the start and end of the page.
+    parser.whitespace = None
+    if firstLine == 1:
+        thing = Document
+        leading = whitespace.match(blockText)
+        if leading:
+            blockText = blockText[leading.end():]
+            firstLine += leading.group(0).count("\n")
+    else:
+        thing = DocumentBlock
+    parser.text = blockText
+    unparsed, parsed = parser.parse(blockText, thing)
+    if lastBlock and whitespace.fullmatch(unparsed):
+        unparsed = ""
+
+    stats = {}
+    if packrat:
+        stats["packratLookups"] = parser._memory.lookups
+        stats["packratHits"] = parser._memory.hits
+    if unparsed:
+        e = parser.last_error
+        lineNo = e.lineno
+        if lineNo is not None:
+            lineNo += firstLine - 1
+        return(SyntaxError(e.msg, (e.filename, lineNo, e.offset, e.text)), stats)
+    return(parsed, stats)
+
+
+def parseBlocks(moinText, packrat=False, pool=None, stats=None, recover=False):
+    """
+    Parse a preprocessed page as a Document, a block at a time (see
+    splitBlocks).  Raises the SyntaxError of the first block that doesn't
+    parse, as parsing the whole page would, unless recover is true.  Then
+    each block that doesn't parse goes into the Document as an
+    UnparsedBlock instead, and the rest of the page is parsed as usual.
+
+    pool: something with a map method, like a multiprocessing.Pool, to
+          parse the blocks with in parallel.  None to parse them here.
+    packrat: parse with a PackratParser.  Its lookups and hits are added up
+             in stats, if stats is a dict.
+    """
+    document = Document()
+    for parsedBlock in parsedBlocks(moinText, packrat, pool, stats, recover):
+        document.extend(parsedBlock)
+    return(document)
+
+
+def parsedBlocks(moinText, packrat=False, pool=None, stats=None, recover=False):
+    """
+    Parse a preprocessed page a block at a time, as parseBlocks does, but
+    yield each block's top level items as a list, as soon as it is parsed.
+    Without a pool, a block isn't parsed until the one before it has been
+    used.
+    """
+    blocks = splitBlocks(moinText)
+    jobs = []
+    firstLine = 1
+    for blockIdx, blockText in enumerate(blocks):
+        jobs.append([blockText, firstLine, blockIdx == len(blocks) - 1, packrat])
+        firstLine += blockText.count("\n")
+    if pool is None:
+        results = map(parseBlock, jobs)
+    else:
+        results = pool.map(parseBlock, jobs)
+
+    for blockText, (parsedBlock, blockStats) in zip(blocks, results):
+        if stats is not None:
+            for name, value in blockStats.items():
+                stats[name] = stats.get(name, 0) + value
+        if isinstance(parsedBlock, SyntaxError):
+            if not recover:
+                raise parsedBlock
+            unparsed = UnparsedBlock(blockText)
+            unparsed.error = parsedBlock
+            yield([unparsed])
+        else:
+            yield(parsedBlock)
+
+
 def printList(list, indent=0):
     for item in list:
         print("." * indent, item)
@@ -3549,12 +4186,6 @@ def printList(list, indent=0):
 
 def runTests():
     global args
-    global pageYaml
-    global pageDepth
-
-    pageDepth = args.args.pagedepth
-
-    pageYaml = {}
 
     CellMoinFormatItem.test()
     CellClass.test()
@@ -3578,6 +4209,7 @@ def runTests():
     Paragraph.test()
     Element.test()
     Document.test()
+    UnparsedBlock.test()
 
     text = identifyIndents("""
 <<Include(Develop/LinkBox)>>
@@ -3619,6 +4251,69 @@ This is the '''hub page''' for the section of ''this wiki'' on how to deploy and
 
     markdownText = compose(f)
 
+    # Parsing with the packrat memo must give the same page.
+    stats = {}
+    if compose(packratParse(text, Document, stats)) != markdownText or not stats["packratHits"]:
+        raise BaseException("packratParse")
+
+    # So must parsing it a block at a time.
+    blocks = splitBlocks(text)
+    if "".join(blocks) != text or len(blocks) < 2 or compose(parseBlocks(text)) != markdownText:
+        raise BaseException("parseBlocks")
+    if splitBlocks("{{{\n= Code =\n\n}}}\n\n[[Link\n\n]]\n\n|| a ||\n|| b ||\n= H =\n") != [
+            "{{{\n= Code =\n\n}}}\n\n", "[[Link\n\n]]\n\n", "|| a ||\n|| b ||\n", "= H =\n"]:
+        raise BaseException("splitBlocks")
+
+    # A page without markup is its own translation, with or without parsing it.
+    plainText = "Plain prose, (with) some punctuation; it's well-known.\n\nAnother  line!\n"
+    if not isPlainPage(plainText) or isPlainPage(text):
+        raise BaseException("isPlainPage")
+    global plainPageFastPath
+    for plainPageFastPath in [False, True]:
+        if translateMoinText(plainText).page() != plainText:
+            raise BaseException("plainPageFastPath")
+    # Packrat parsing reports its memo use even when there's nothing to parse.
+    stats = {}
+    if (translateMoinText(plainText, timings=stats, packrat=True).page() != plainText or
+        stats["packratLookups"] != 0 or stats["packratHits"] != 0):
+        raise BaseException("plainPageFastPath packrat")
+
+    # Pages are classified by the comments and processing instructions at their top.
+    for pageStart, pageKind in [("#format text/creole\n= T =\n", "creole"),
+                                ("## comment\n#format wiki\n#REDIRECT FrontPage\n", "redirect"),
+                                ("#language en\n#refresh 0 http://x.org/\n", "refresh"),
+                                ("\n#pragma section-numbers off\n= T =\n#redirect X\n", "wiki"),
+                                ("#acl All:read\n#redirect X\n", "wiki")]:
+        if classifyPage(pageStart) != pageKind:
+            raise BaseException("classifyPage")
+
+    # A block that doesn't parse is passed through, and the rest translated.
+    translation = translateMoinText("= Title =\n\n|| a\n\nSome '''text'''\n")
+    if (translation.markdown != "# Title\n\n```PLACEHOLDER_UNPARSED\n|| a\n```\n\nSome **text**\n" or
+        len(translation.diagnostics) != 1):
+        raise BaseException("UnparsedBlock")
+
+    # Streaming a page to a file gives the same bytes and hash as the whole
+    # page does, with and without front matter, and leaves no .tmp behind.
+    global streamPages
+    streamPages = True
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for pageText in ["<<TableOfContents>>\n= Café =\n\n" + text, text]:
+            moinPath = os.path.join(tmpDir, "Page.moin")
+            mdPath = os.path.join(tmpDir, "Page.md")
+            with open(moinPath, "w") as moinFile:
+                moinFile.write(pageText)
+            timings = {}
+            if translate(moinPath, mdPath, "/src", 0, timings) is not None:
+                raise BaseException("streamPages")
+            markdownText = translateMoinText(pageText, "/src", 0).page()
+            with open(mdPath, "rb") as mdFile:
+                mdBytes = mdFile.read()
+            if (mdBytes != markdownText.encode("utf-8") or
+                timings["destSha256"] != hashlib.sha256(mdBytes).hexdigest() or
+                sorted(os.listdir(tmpDir)) != ["Page.md", "Page.moin"]):
+                raise BaseException("writeChunks")
+
     if args.args.debug:
         print("\n====\n====\nDEBUG: DOCUMENT UNIT TEST DONE\n====\n====")
 
@@ -3631,54 +4326,433 @@ This is the '''hub page''' for the section of ''this wiki'' on how to deploy and
 # Can be run as a standalone program or called from another program.
 # #########################################
 
-def translate(srcFilePath, destFilePath, root, depth):
+def frontMatterText(frontMatter):
+    """
+    Return the YAML front matter block for a page, or "" if it has none.
+    Keys are sorted, so the same page always gets the same block.
+    """
+    if len(frontMatter) == 0:
+        return("")
+    yamlLines = ["---\n"]
+    for name in sorted(frontMatter.keys()):
+        yamlLines.append(name +": " + frontMatter[name] + "\n")
+    yamlLines.append("---\n")
+    return("".join(yamlLines))
+
+
+# Kinds of page we don't translate, and why.
+UNTRANSLATED_PAGE_KINDS = {
+    "creole": "Creole parsing is not supported.",
+    "redirect": "Not generating REDIRECT Pages. Letting them die.",
+    "refresh": "Not generating refresh Pages. Letting them die."}
+
+# How much of a page classifyFile reads.
+PAGE_HEADER_BYTES = 512
+
+
+def classifyPage(pageStart):
+    """
+    Say what kind of page this is, from the start of its text: "creole",
+    "redirect", "refresh" (see UNTRANSLATED_PAGE_KINDS), or "wiki".
+
+    Only the comments and processing instructions at the top of the page
+    are looked at, as the grammar would: a #redirect after anything else
+    isn't a redirect.  A page whose top doesn't say otherwise is "wiki".
+    """
+    if pageStart[0:19] == "#format text/creole":
+        return("creole")
+    pageText = pageStart.lstrip()
+    leading = pageStart[0:len(pageStart) - len(pageText)]
+    leading = leading[leading.rfind("\n") + 1:]
+    if leading and leading.strip(" ") == "":
+        return("wiki")                    # an indented line (see identifyIndents)
+    for line in LINES.findall(pageText):
+        if line.startswith("##") or re.match(r"(#format wiki|#language en)[ \t\f\v]*\n|#pragma ",
+                                             line):
+            continue
+        elif re.match(r"#format text/creole[ \t\f\v]*\n", line):
+            return("creole")
+        elif re.match(r"#redirect ", line, re.IGNORECASE):
+            return("redirect")
+        elif line.startswith("#refresh "):
+            return("refresh")
+        break
+    return("wiki")
+
+
+def classifyFile(srcFilePath):
+    """
+    classifyPage for a file, reading only its first PAGE_HEADER_BYTES.
+    """
+    with open(srcFilePath, "rb") as moinFile:
+        header = moinFile.read(PAGE_HEADER_BYTES)
+    pageStart = header.decode("utf-8", "ignore")
+    if len(header) == PAGE_HEADER_BYTES:
+        pageStart = pageStart[0:pageStart.rfind("\n") + 1]  # only whole lines
+    return(classifyPage(pageStart))
+
+
+class Translation(object):
+    """
+    The result of translating one page.
+    """
+
+    def __init__(self, markdown, frontMatter, diagnostics, parsed):
+        """
+        markdown: the translated page, without its front matter
+        frontMatter: dict of YAML front matter for the page
+        diagnostics: list of warnings about the translation
+        parsed: the parse tree of the page
+        """
+        self.markdown = markdown
+        self.frontMatter = frontMatter
+        self.diagnostics = diagnostics
+        self.parsed = parsed
+
+        return(None)
+
+    def page(self):
+        """
+        Return the whole page, front matter and all, as translate writes it.
+        """
+        return(frontMatterText(self.frontMatter) + self.markdown)
+
+
+def parseMoinText(moinText, timings, packrat=False, pool=None, recover=True):
+    """
+    Preprocess the text of a page.  Returns a generator that parses it a
+    block at a time (see parsedBlocks), and yields the top level items of
+    its Document, in order.  Raises NotImplementedError if the page uses
+    markup we don't translate.
+
+    timings, packrat, pool, recover: see translateMoinText.  The seconds
+    spent parsing, and the number of unparsedBlocks, add up as the
+    generator goes.
+    """
+    # if it's creole, give it up, as the parsing errors can happen anywhere.
+    # Redirects and refreshes aren't worth parsing either.
+    pageKind = classifyPage(moinText[0:PAGE_HEADER_BYTES])
+    if pageKind != "wiki":
+        raise NotImplementedError(UNTRANSLATED_PAGE_KINDS[pageKind])
+
+    phaseStart = time.perf_counter()
+    plainPage = plainPageFastPath and isPlainPage(moinText)
+    if not plainPage:
+        # Replace the mystery character with a space, and leading spaces on
+        # lines with @INDENT-n@ where n is the number of spaces. PyPeg often
+        # strips them, causing havoc with lists.
+        moinText = preprocess(moinText)
+    timings["preprocess"] = time.perf_counter() - phaseStart
+
+    timings["parse"] = 0.0
+    timings["unparsedBlocks"] = 0
+    if plainPage:
+        # Nothing to parse; the page is one long PlainText.
+        if packrat:
+            timings["packratLookups"] = timings["packratHits"] = 0
+        plainText = PlainText()
+        plainText.text = moinText
+        return(iter([plainText]))
+    return(parseItems(parsedBlocks(moinText, packrat, pool, timings, recover), timings))
+
+
+def parseItems(blocks, timings):
+    """
+    Yield the top level items of each block from parsedBlocks, adding the
+    time spent parsing them, and the number of unparsedBlocks, to timings.
+    """
+    while True:
+        phaseStart = time.perf_counter()
+        block = next(blocks, None)
+        timings["parse"] += time.perf_counter() - phaseStart
+        if block is None:
+            return
+        for item in block:
+            if isinstance(item, UnparsedBlock):
+                timings["unparsedBlocks"] += 1
+            yield(item)
+
+
+def composeChunks(items, context, timings):
+    """
+    Compose a page a top level item at a time, yielding the Markdown for
+    each in order.  Together they are what composing the whole Document
+    gives.  The seconds spent composing are added to timings, as compose.
+
+    The page's front matter, context.pageYaml, and its diagnostics are only
+    complete once every chunk has been composed: a title div or table of
+    contents can be anywhere in the page.
+    """
+    parser = MoinParser(context)
+    timings["compose"] = timings.get("compose", 0.0)
+    for item in items:
+        phaseStart = time.perf_counter()
+        chunk = compose(item, parser)
+        timings["compose"] += time.perf_counter() - phaseStart
+        yield(chunk)
+
+
+def translateMoinText(moinText, root="/src", depth=0, timings=None, packrat=False,
+                      pool=None, recover=True):
+    """
+    Translate the text of a page from MoinMoin markup to GFM, without touching
+    any files.  Returns a Translation.  Raises NotImplementedError if the page
+    uses markup we don't translate.
+
+    Each call has a TranslationContext of its own, so it can be called from
+    any number of threads at once.
+
+    If timings is a dict, the seconds spent in the preprocess, parse and
+    compose phases are added to it.
+
+    packrat: parse with a PackratParser.  Its lookups and hits are added to
+    timings, as packratLookups and packratHits.
+
+    The page is parsed a block at a time (see splitBlocks).  pool: something
+    with a map method, like a multiprocessing.Pool, to parse the blocks in
+    parallel.
+
+    recover: blocks that don't parse are passed through as they are (see
+    UnparsedBlock), with a warning for each, and counted in timings as
+    unparsedBlocks.  If recover is false, they raise a SyntaxError.
+    """
+    if timings is None:
+        timings = {}
+    parsedMoin = Document(list(parseMoinText(moinText, timings, packrat, pool, recover)))
+    context = TranslationContext(root, depth)
+    markdownText = "".join(composeChunks(parsedMoin, context, timings))
+    return(Translation(markdownText, dict(context.pageYaml), context.diagnostics(),
+                       parsedMoin))
+
+
+# Set to False to parse and compose whole pages before writing them, even
+# when they are written straight to a file.
+streamPages = True
+
+
+def writeChunks(destFilePath, chunks, context):
+    """
+    Write a page to destFilePath as it is composed, a chunk at a time, so
+    the whole of it is never in memory at once.  Returns the sha256 of the
+    page, as UTF-8.
+
+    The front matter has to come first, but isn't known until the last chunk
+    is composed.  So the chunks go into a file next to destFilePath, which
+    is renamed into place if the page has no front matter.  If it has,
+    destFilePath is written with the front matter, and then the chunks are
+    copied in after it.
+    """
+    bodyFilePath = destFilePath + ".tmp"
+    pageSha256 = hashlib.sha256()
+    try:
+        with open(bodyFilePath, "w") as bodyFile:
+            for chunk in chunks:
+                bodyFile.write(chunk)
+                pageSha256.update(chunk.encode("utf-8"))
+        header = frontMatterText(context.pageYaml)
+        if not header:
+            os.replace(bodyFilePath, destFilePath)
+            return(pageSha256.hexdigest())
+
+        pageSha256 = hashlib.sha256(header.encode("utf-8"))
+        with open(destFilePath, "w") as markdownFile, open(bodyFilePath) as bodyFile:
+            markdownFile.write(header)
+            while True:
+                block = bodyFile.read(1 << 16)
+                if not block:
+                    break
+                markdownFile.write(block)
+                pageSha256.update(block.encode("utf-8"))
+    finally:
+        if os.path.exists(bodyFilePath):
+            os.remove(bodyFilePath)
+    return(pageSha256.hexdigest())
+
+
+def reportWarnings(pageWarnings, warnings=None):
+    """
+    Print a page's warnings to stderr, or add them to warnings, if it's a list.
+    """
+    if warnings is None:
+        for warning in pageWarnings:
+            print("Warning: " + warning, file=sys.stderr)
+    else:
+        warnings.extend(pageWarnings)
+
+
+def translate(srcFilePath, destFilePath, root, depth, timings=None, writer=None,
+              packrat=False, pool=None, recover=True, warnings=None):
     """
     Translate a file from MoinMoin markup to GFM.
+
+    If timings is a dict, it is filled in with the seconds spent in each
+    phase (read, preprocess, parse, compose, write), the size in bytes of
+    the source and destination files (srcBytes, destBytes), and the sha256 of
+    the translated page, as UTF-8 (destSha256).  Phases that are not reached
+    (because the page is not translatable) are not filled in.
+
+    If writer is given, it is called as writer(destFilePath, markdownText)
+    instead of writing destFilePath here.  The write phase then only times
+    handing the text over.
+
+    Otherwise, with streamPages, the page is parsed, composed and written a
+    block at a time (see writeChunks), so only one block's parse tree is
+    kept at once.  The write phase is then the time spent writing.
+
+    Returns the parse tree of the page, or None if it was streamed.
+
+    Warnings about the page are printed to stderr, or, if warnings is a
+    list, added to it for the caller to report.
+
+    packrat, pool, recover: see translateMoinText.
     """
-    resetState()                     # clear out any crap from previous run
+    if timings is None:
+        timings = {}
+    phaseStart = time.perf_counter()
     moinFile = open(srcFilePath, "r")
     moinText = moinFile.read()
     moinFile.close()
-    # wikiroot is used to generate all absolute links.
-    # PageDepth is used to generate relative URLs
-    global pageDepth
-    pageDepth = depth
-    global wikiRoot
-    wikiRoot = root
-    global wikiRootParts
-    wikiRootParts = wikiRoot.split("/")
-    wikiRootParts.pop(0) # first one is empty
+    timings["srcBytes"] = os.path.getsize(srcFilePath)
+    timings["read"] = time.perf_counter() - phaseStart
+
+    if writer is None and streamPages:
+        items = parseMoinText(moinText, timings, packrat, pool, recover)
+        del moinText                      # the preprocessed text is all that's needed
+        context = TranslationContext(root, depth)
+        phaseStart = time.perf_counter()
+        timings["destSha256"] = writeChunks(
+            destFilePath, composeChunks(items, context, timings), context)
+        timings["write"] = (time.perf_counter() - phaseStart -
+                            timings["parse"] - timings["compose"])
+        timings["destBytes"] = os.path.getsize(destFilePath)
+        reportWarnings(context.diagnostics(), warnings)
+        return(None)
 
-    # if it's creole, give it up, as the parsing errors can happen anywhere.
-    if moinText[0:19] == "#format text/creole":
-        raise NotImplementedError("Creole parsing is not supported.")
-
-    # Replace the mystery character with a space.
-    moinText = re.sub(" ", " ", moinText)
-
-    # Replace leading spaces on lines  with @INDENT-n@ where n is the
-    # number of spaces. PyPeg often strips them, causing havoc with lists.  
-    moinText = identifyIndents(moinText)
-
-    # Each page can have leading YAML.  There's probably a way to deal with this
-    # gracefully in PyPeg, but I'll just hack it with a Global.
-    global pageYaml
-    pageYaml = {}
-        
-    parsedMoin = parse(moinText, Document)
-    markdownText = compose(parsedMoin)
-    markdownFile = open(destFilePath, "w")
-
-    if len(pageYaml) > 0:
-        markdownFile.write("---\n")
-        for name in sorted(pageYaml.keys()):
-            markdownFile.write(name +": " + pageYaml[name] + "\n")
-        markdownFile.write("---\n")
-            
-    markdownFile.write(markdownText)
-    markdownFile.close()
+    translation = translateMoinText(moinText, root, depth, timings, packrat, pool, recover)
+    reportWarnings(translation.diagnostics, warnings)
+
+    phaseStart = time.perf_counter()
+    markdownText = translation.page()
+    timings["destSha256"] = hashlib.sha256(markdownText.encode("utf-8")).hexdigest()
+
+    if writer is not None:
+        writer(destFilePath, markdownText)
+        timings["write"] = time.perf_counter() - phaseStart
+        timings["destBytes"] = len(markdownText.encode("utf-8"))
+    else:
+        markdownFile = open(destFilePath, "w")
+        markdownFile.write(markdownText)
+        markdownFile.close()
+        timings["write"] = time.perf_counter() - phaseStart
+        timings["destBytes"] = os.path.getsize(destFilePath)
+
+    return(translation.parsed)
+
+
+def batchPages():
+    """
+    Return [moinPage, mdPage, wikiroot, pagedepth] for every page given with
+    --pagelist, --glob or --manifest.
+    """
+    pages = []                            # [moinPage, mdPage or None]
+    if args.args.pagelist:
+        with open(args.args.pagelist) as pageList:
+            for line in pageList:
+                line = line.rstrip("\n")
+                if line.strip():
+                    parts = line.split("\t")
+                    pages.append([parts[0], (parts[1:] or [None])[0]])
+    if args.args.glob:
+        for moinPage in sorted(glob.glob(args.args.glob, recursive=True)):
+            if os.path.isfile(moinPage):
+                pages.append([moinPage, None])
+
+    # Work out where pages that didn't say go.
+    undecided = [os.path.abspath(moinPage) for moinPage, mdPage in pages if mdPage is None]
+    if undecided and args.args.mddir:
+        commonDir = os.path.commonpath([os.path.dirname(moinPage) for moinPage in undecided])
+    for page in pages:
+        if page[1] is None:
+            mdPage = page[0]
+            if args.args.mddir:
+                mdPage = os.path.join(args.args.mddir,
+                                      os.path.relpath(os.path.abspath(page[0]), commonDir))
+            page[1] = re.sub(r"\.moin$", "", mdPage) + ".md"
+
+    jobs = [[moinPage, mdPage, args.args.wikiroot, args.args.pagedepth]
+            for moinPage, mdPage in pages]
+    if args.args.manifest:
+        with open(args.args.manifest) as manifestFile:
+            for line in manifestFile:
+                if line.strip():
+                    entry = json.loads(line)
+                    jobs.append([entry["moinpage"], entry["mdpage"],
+                                 entry.get("wikiroot", args.args.wikiroot),
+                                 int(entry.get("pagedepth", args.args.pagedepth))])
+    return(jobs)
+
+
+def translateBatchPage(job):
+    """
+    Translate one page of a batch, creating the directory it goes in.
+    Returns [moinPage, problem], where problem is None if the page was
+    translated.
+
+    Everything the page needs is in job, as pool workers can't rely on the
+    command line arguments (a spawned worker never sets them).
+    """
+    moinPage, mdPage, root, depth, packrat, recover = job
+    try:
+        mdDir = os.path.dirname(mdPage)
+        if mdDir:
+            os.makedirs(mdDir, exist_ok=True)
+        warnings = []
+        translate(moinPage, mdPage, root, depth, packrat=packrat, recover=recover,
+                  warnings=warnings)
+        for warning in warnings:
+            print("Warning: " + moinPage + ": " + warning, file=sys.stderr)
+    except NotImplementedError as e:
+        return([moinPage, "Not Implemented: " + e.args[0]])
+    except Exception as e:
+        return([moinPage, type(e).__name__ + ": " + str(e)])
+    return([moinPage, None])
+
+
+def translateBatch(jobs, nJobs, packrat=False, recover=True):
+    """
+    Translate every page in jobs (from batchPages), in this process or in a
+    pool of nJobs processes.  Either way, the grammar is only set up once per
+    process, rather than once per page.
+
+    packrat, recover: see translateMoinText.
+
+    Returns a list of [moinPage, problem] for the pages that weren't
+    translated.
+    """
+    jobs = [job + [packrat, recover] for job in jobs]
+    if nJobs > 1:
+        pool = multiprocessing.Pool(nJobs)
+        results = pool.imap(translateBatchPage, jobs,
+                            chunksize=max(1, len(jobs) // (nJobs * 4)))
+    else:
+        pool = None
+        results = map(translateBatchPage, jobs)
+
+    problems = []
+    for moinPage, problem in results:
+        if problem is None:
+            print("FILE:", moinPage)
+        else:
+            problems.append([moinPage, problem])
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-    return(parsedMoin)
+    print("Translated " + str(len(jobs) - len(problems)) + " of " + str(len(jobs)) + " pages.")
+    for moinPage, problem in problems:
+        print("  Page: " + moinPage)
+        print("            Err: " + problem + "\n")
+    return(problems)
 
     
 if __name__ == "__main__":
@@ -3686,20 +4760,40 @@ if __name__ == "__main__":
 
     args = Argghhs()                          # process command line arguments
 
-    global pageDepth
-    pageDepth = args.args.pagedepth
-    global wikiRoot
-    wikiRoot = args.args.wikiroot
-    global wikiRootParts
-    wikiRootParts = wikiRoot.split("/")
-    wikiRootParts.pop(0) # first one is empty
-
-
     if args.args.runtests:
         runTests()
 
+    if args.args.pagelist or args.args.glob or args.args.manifest:
+        problems = translateBatch(batchPages(), args.args.jobs, args.args.packrat,
+                                  not args.args.strict)
+        if [problem for moinPage, problem in problems
+            if not problem.startswith("Not Implemented: ")]:
+            sys.exit(1)
+
     if args.args.moinpage:
-        parsedMoin = translate(args.args.moinpage, args.args.mdpage)
+        timings = {}
+        pool = None
+        if args.args.debug:
+            streamPages = False           # to have the whole tree to print
+        if args.args.blockjobs > 1:
+            pool = multiprocessing.Pool(args.args.blockjobs)
+        if args.args.mdpage:
+            parsedMoin = translate(args.args.moinpage, args.args.mdpage,
+                                   args.args.wikiroot, args.args.pagedepth,
+                                   timings, packrat=args.args.packrat, pool=pool,
+                                   recover=not args.args.strict)
+        else:
+            parsedMoin = translate(args.args.moinpage, None,
+                                   args.args.wikiroot, args.args.pagedepth, timings,
+                                   writer=lambda mdPage, markdownText: sys.stdout.write(markdownText),
+                                   packrat=args.args.packrat, pool=pool,
+                                   recover=not args.args.strict)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if args.args.packrat:
+            print("Packrat memo: %d hits in %d lookups" % (
+                timings["packratHits"], timings["packratLookups"]), file=sys.stderr)
         if args.args.debug:
             print("DEBUG: DOCUMENT in PARSED FORM:")
             printList(parsedMoin, 2)
@@ -7,36 +7,883 @@
 import os
 import os.path
 import argparse
+import csv
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import queue as queueModule
+import resource
+import sys
+import threading
+import time
+import traceback
+import migrationQueue
+import pageWriters
 import parseMoinToMarkdown
 
 notImplementedPages = []                  # Pages containing makup that we aren't translating
+failedPages = []                          # Pages we couldn't translate for any other reason
+pageTimings = []                          # One record per page we tried to translate
+workerStats = None                        # Memory use of pool workers, when using --jobs
+pageWriter = None                         # Writes pages for us, with --backgroundwrites or --outputarchive
+forkedPageWriter = None                   # Pool's pageWriter, as inherited by a --jobs worker
+
+TIMED_PHASES = ["read", "preprocess", "parse", "compose", "write"]
+
+def shardSpec(text):
+    """
+    Convert a --shard argument of the form i/N into (i, N), where 0 <= i < N.
+    """
+    try:
+        shardIdx, nShards = [int(part) for part in text.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must look like i/N, for example 0/4")
+    if nShards < 1 or shardIdx < 0 or shardIdx >= nShards:
+        raise argparse.ArgumentTypeError("shard i/N must have 0 <= i < N")
+    return((shardIdx, nShards))
+
 
 class Argghhs(object):
     """
     Process and provide access to command line arguments.
     """
 
-    def __init__(self):
+    def __init__(self, options=None):
+        """
+        options: already parsed arguments (used by pool workers), or None to
+        parse the command line.
+        """
+        if options is not None:
+            self.args = options
+            return(None)
+
         argParser = argparse.ArgumentParser(
             description='Convert all pages from MoinMoin to Markdown.',
             epilog = 'Example:\n    runMigration.py --srcdir="MoinPages" --destdir="MarkdownPages --wikiroot="/src" --onlynew')
         argParser.add_argument(
-            "--srcdir", required=True,
+            "--srcdir", required=False, default=None,
             help="Path of directory to get Moin pages from")
         argParser.add_argument(
-            "--destdir", required=True,
-            help="Path of directory to put translated pages into")
+            "--destdir", required=False, default=None,
+            help="Path of directory to put translated pages into.  Not needed with --outputarchive.")
         argParser.add_argument(
-            "--wikiroot", required=True,
+            "--wikiroot", required=False, default=None,
             help="Root of all links used inside the wiki.  For example, /src.")
         argParser.add_argument(
             "--onlynew", required=False, action="store_true",
             help="Only translate pages you haven't already translated")
+        argParser.add_argument(
+            "--report", required=False, default=None,
+            help="Write per page timings to this file.  Format is CSV if the name ends in .csv, JSON otherwise.")
+        argParser.add_argument(
+            "--slowest", required=False, type=int, default=20,
+            help="Number of slowest pages to list in the report.  Default is 20.")
+        argParser.add_argument(
+            "--shard", required=False, type=shardSpec, default=None,
+            help="Only translate shard i of N, for example 0/4.  Pages are assigned to shards by a stable hash of their path, so N runs with shards 0/N to N-1/N translate every page exactly once.")
+        argParser.add_argument(
+            "--manifest", required=False, default=None,
+            help="Write a JSON manifest of this run (including Not Implemented pages) to this file.  mergeMigrationShards.py combines shard manifests.")
+        argParser.add_argument(
+            "--queue", required=False, default=None,
+            help="SQLite work queue file.  The first run loads every page into the queue; every run (on any host that can see the file) then claims and translates pages until none are left.  Rerunning resumes where the queue left off.")
+        argParser.add_argument(
+            "--lease", required=False, type=float, default=600,
+            help="Seconds a queue worker can hold a page before it is assumed to have crashed, and the page is handed to another worker.  Default is 600.")
+        argParser.add_argument(
+            "--queuestatus", required=False, action="store_true",
+            help="Print how far along the --queue is, and exit.")
+        argParser.add_argument(
+            "--watch", required=False, action="store_true",
+            help="After translating, keep watching --srcdir and retranslate pages as they change.  Stop with Ctrl-C.")
+        argParser.add_argument(
+            "--interval", required=False, type=float, default=1.0,
+            help="Seconds between checks for changed pages in --watch mode.  Default is 1.")
+        argParser.add_argument(
+            "--jobs", required=False, type=int, default=1,
+            help="Number of worker processes to translate pages with.  Default is 1, which translates pages in this process.")
+        argParser.add_argument(
+            "--backend", required=False, choices=["process", "thread"], default="process",
+            help="What --jobs workers are.  process: separate processes (the default); thread: threads in this process, which share the loaded grammar.  Threads only translate in parallel on a free-threaded (no GIL) Python.")
+        argParser.add_argument(
+            "--maxpagesperworker", required=False, type=int, default=0,
+            help="Replace a --jobs worker with a fresh process after it has translated this many pages.  Default is 0, never.")
+        argParser.add_argument(
+            "--maxworkerrss", required=False, type=float, default=0,
+            help="Replace a --jobs worker with a fresh process once its resident memory exceeds this many MB.  Default is 0, never.")
+        argParser.add_argument(
+            "--schedule", required=False, choices=["walk", "size", "time"], default="size",
+            help="Order to hand pages to --jobs workers and --queue workers in.  walk: directory order; size: largest source file first; time: slowest page in --previousreport first.  Default is size.")
+        argParser.add_argument(
+            "--previousreport", required=False, default=None,
+            help="JSON --report from an earlier run, used by --schedule time.")
+        argParser.add_argument(
+            "--backgroundwrites", required=False, action="store_true",
+            help="Write translated pages from a background thread, in batches, so translating never waits on the disk.  Pages are written to a temporary file and renamed into place.")
+        argParser.add_argument(
+            "--writebatch", required=False, type=int, default=32,
+            help="Most pages to write in one batch with --backgroundwrites.  Default is 32.")
+        argParser.add_argument(
+            "--fsync", required=False, action="store_true",
+            help="With --backgroundwrites, fsync each batch of pages (and their directories) before moving on.")
+        argParser.add_argument(
+            "--outputarchive", required=False, default=None,
+            help="Write translated pages straight into this archive, rather than into --destdir.  The name says what kind: .zip, .tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz.")
+        argParser.add_argument(
+            "--packrat", required=False, action="store_true",
+            help="Parse with a packrat memo keyed by position.  Memo lookups and hits are reported for each page.")
+        argParser.add_argument(
+            "--strict", required=False, action="store_true",
+            help="Fail a page if any of it doesn't parse.  By default, blocks that don't parse are passed through as they are, in a PLACEHOLDER_UNPARSED code block, and the page is translated anyway.")
+        argParser.add_argument(
+            "--hashes", required=False, default=None,
+            help="Write the sha256 of every translated page to this JSON file, keyed by the page's path in --destdir.  With --onlynew, --shard or --queue, pages are added to the existing file (under a lock, so runs can share it), and pages this run didn't translate keep their entries.")
         self.args = argParser.parse_args()
 
+        if self.args.outputarchive:
+            if pageWriters.archiveFormat(self.args.outputarchive) is None:
+                argParser.error("--outputarchive must end in one of: " +
+                                ", ".join([ending for ending, mode in pageWriters.ARCHIVE_FORMATS]))
+            for conflict in ["queue", "watch", "onlynew", "backgroundwrites"]:
+                if getattr(self.args, conflict):
+                    argParser.error("--outputarchive and --" + conflict + " can't be used together")
+            if self.args.destdir is None:
+                self.args.destdir = "."   # only used to name pages in the archive
+        if not self.args.queuestatus:
+            for required in ["srcdir", "destdir", "wikiroot"]:
+                if getattr(self.args, required) is None:
+                    argParser.error("the following arguments are required: --" + required)
+        elif not self.args.queue:
+            argParser.error("--queuestatus requires --queue")
+        if self.args.queue and self.args.shard:
+            argParser.error("--shard and --queue can't be used together")
+        if self.args.queue and self.args.watch:
+            argParser.error("--watch and --queue can't be used together")
+        if self.args.jobs < 1:
+            argParser.error("--jobs must be at least 1")
+        if self.args.backend == "thread" and (self.args.maxpagesperworker or self.args.maxworkerrss):
+            argParser.error("--maxpagesperworker and --maxworkerrss only apply to --backend process")
+        if self.args.jobs > 1 and self.args.queue:
+            argParser.error("--jobs and --queue can't be used together; start more queue workers instead")
+        if self.args.backgroundwrites and self.args.queue:
+            argParser.error("--backgroundwrites can't be used with --queue; pages would be marked done before they are written")
+        if self.args.fsync and not self.args.backgroundwrites:
+            argParser.error("--fsync requires --backgroundwrites")
+        if self.args.writebatch < 1:
+            argParser.error("--writebatch must be at least 1")
+        if self.args.schedule == "time" and not self.args.previousreport:
+            argParser.error("--schedule time requires --previousreport")
+        if self.args.previousreport:
+            try:
+                readPreviousReport(self.args.previousreport)
+            except (OSError, ValueError) as e:
+                argParser.error("--previousreport: " + str(e))
+
         return(None)
 
 
+def readPreviousReport(reportPath):
+    """
+    Read a JSON --report from an earlier run.  Raises ValueError if it isn't
+    one (e.g., it's a CSV report).
+    """
+    with open(reportPath) as reportFile:
+        try:
+            report = json.load(reportFile)
+        except ValueError:
+            raise ValueError(reportPath + " is not a JSON report; write one with --report NAME.json")
+    if (not isinstance(report, dict) or not isinstance(report.get("pages"), list) or
+        not isinstance(report.get("bytesPerSecond"), dict)):
+        raise ValueError(reportPath + " is not a runMigration.py JSON report")
+    return(report)
+
+
+def pageShard(srcfile, nShards):
+    """
+    Return the shard a page belongs in.
+
+    The hash is of the page's path relative to the source directory, so it
+    is the same on every host, no matter where the Moin mirror is.
+    """
+    relPath = os.path.relpath(srcfile, args.args.srcdir).replace(os.sep, "/")
+    digest = hashlib.sha1(relPath.encode("utf-8")).hexdigest()
+    return(int(digest, 16) % nShards)
+
+
+def writeManifest(manifestPath):
+    """
+    Record what this run did, so that shard runs can be merged.
+    """
+    manifest = {
+        "srcdir": os.path.abspath(args.args.srcdir),
+        "destdir": os.path.abspath(args.args.destdir),
+        # So the pages can be found wherever they and the manifest are moved to.
+        "destdirFromManifest": os.path.relpath(
+            os.path.abspath(args.args.destdir), os.path.dirname(os.path.abspath(manifestPath))),
+        "wikiroot": args.args.wikiroot,
+        "shard": None,
+        "pages": sorted([os.path.relpath(record["page"], args.args.srcdir)
+                         for record in pageTimings]),
+        "notImplementedPages": sorted(notImplementedPages),
+        "failedPages": sorted(failedPages),
+        "pageKinds": dict(sorted([(os.path.relpath(record["page"], args.args.srcdir),
+                                   record.get("kind")) for record in pageTimings])),
+        "hashes": translatedHashes()}
+    if args.args.shard:
+        manifest["shard"] = "%d/%d" % args.args.shard
+    with open(manifestPath, "w") as manifestFile:
+        json.dump(manifest, manifestFile, indent=2)
+        manifestFile.write("\n")
+
+
+def translatedHashes():
+    """
+    Return the sha256 of every page translated so far, keyed by its path in
+    --destdir, sorted.
+    """
+    hashes = {}
+    for record in pageTimings:
+        if record["status"] == "translated":
+            hashes[record["dest"]] = record["destSha256"]
+    return(dict(sorted(hashes.items())))
+
+
+def writeHashes(hashesPath):
+    """
+    Write the sha256 of every page translated so far, keyed by its path in
+    --destdir, so a deploy step can upload only the pages that changed.
+    Keys are sorted, so the same pages always give the same file.
+
+    --onlynew runs, and --shard and --queue runs, which share the file with
+    other runs, add their pages to what is already there.  The file is
+    locked while it is read and rewritten, so runs finishing at the same
+    time don't lose each other's pages.
+    """
+    with open(hashesPath, "a+") as hashesFile:
+        fcntl.flock(hashesFile, fcntl.LOCK_EX)
+        hashes = {}
+        hashesFile.seek(0)
+        hashesText = hashesFile.read()
+        if (args.args.onlynew or args.args.shard or args.args.queue) and hashesText.strip():
+            hashes = json.loads(hashesText)
+        hashes.update(translatedHashes())
+        hashesFile.seek(0)
+        hashesFile.truncate()
+        json.dump(hashes, hashesFile, indent=2, sort_keys=True)
+        hashesFile.write("\n")
+
+
+def startPageWriter(inWorker=False):
+    """
+    Start the pageWriter: an archive writer with --outputarchive, or a
+    background writer with --backgroundwrites.  Pool workers (inWorker) send
+    archived pages back to the pool instead, which writes them to the archive.
+    """
+    global pageWriter, forkedPageWriter
+    if inWorker:
+        # Keep the pool's writer (e.g., a half written archive) alive and
+        # untouched.  If it were garbage collected here, it would flush the
+        # pool's buffered data into the pool's archive file.
+        forkedPageWriter = pageWriter
+    if args.args.outputarchive:
+        if inWorker:
+            pageWriter = pageWriters.CollectingWriter()
+        else:
+            pageWriter = pageWriters.ArchiveWriter(args.args.outputarchive, args.args.destdir)
+    elif args.args.backgroundwrites:
+        pageWriter = pageWriters.BackgroundWriter(
+            batchSize=args.args.writebatch, fsync=args.args.fsync)
+
+
+def translatePage(srcfile, destfile, pageRoot, depth, writer=None):
+    """
+    Translate a single page, recording how long each phase of the translation took.
+    The page is handed to writer, or the pageWriter, to write, if there is one.
+
+    Returns True if the page was translated, False if it contains markup we
+    don't translate, or translating it failed.  Failures don't stop the run;
+    they are recorded in failedPages, and in the page's record as its error.
+    A pageWriters.WriteError does: the writer has dropped pages already
+    recorded as translated, so it's raised rather than blamed on this page.
+
+    Pages are classified first, from their first few hundred bytes (see
+    parseMoinToMarkdown.classifyPage).  Creole, redirect and refresh pages
+    are Not Implemented without reading the rest of them.  The record says
+    what kind of page it was.
+    """
+    global notImplementedPages, failedPages, pageTimings
+
+    timings = {}
+    record = {"page": srcfile, "status": "translated",
+              "dest": os.path.relpath(destfile, args.args.destdir).replace(os.sep, "/")}
+    pageStart = time.perf_counter()
+    try:
+        record["kind"] = parseMoinToMarkdown.classifyFile(srcfile)
+        if record["kind"] != "wiki":
+            timings["srcBytes"] = os.path.getsize(srcfile)
+            timings["read"] = time.perf_counter() - pageStart
+            raise NotImplementedError(parseMoinToMarkdown.UNTRANSLATED_PAGE_KINDS[record["kind"]])
+        if writer is None and pageWriter is not None:
+            writer = pageWriter.write
+        warnings = []
+        parseMoinToMarkdown.translate(srcfile, destfile, pageRoot, depth, timings, writer,
+                                      args.args.packrat, recover=not args.args.strict,
+                                      warnings=warnings)
+        # Name the page, as --jobs and --queue workers' warnings interleave.
+        relPage = os.path.relpath(srcfile, args.args.srcdir).replace(os.sep, "/")
+        for warning in warnings:
+            print("Warning: " + relPage + ": " + warning, file=sys.stderr)
+    except NotImplementedError as e:
+        notImplementedPages.append([srcfile, e.args[0]])
+        record["status"] = "notimplemented"
+    except pageWriters.WriteError:
+        raise
+    except Exception as e:
+        record["status"] = "failed"
+        record["error"] = type(e).__name__ + ": " + str(e)
+        failedPages.append([srcfile, record["error"]])
+    record["total"] = time.perf_counter() - pageStart
+    for phase in TIMED_PHASES:
+        record[phase] = timings.get(phase, 0.0)
+    record["srcBytes"] = timings.get("srcBytes", 0)
+    record["destBytes"] = timings.get("destBytes", 0)
+    record["destSha256"] = timings.get("destSha256")
+    record["unparsedBlocks"] = timings.get("unparsedBlocks", 0)
+    if args.args.packrat:
+        record["packratLookups"] = timings.get("packratLookups", 0)
+        record["packratHits"] = timings.get("packratHits", 0)
+    if record["total"] > 0:
+        record["bytesPerSecond"] = record["srcBytes"] / record["total"]
+    else:
+        record["bytesPerSecond"] = 0.0
+    pageTimings.append(record)
+
+    return(record["status"] == "translated")
+
+
+def percentile(sortedValues, fraction):
+    """
+    Return the value at fraction (0.0 - 1.0) of the way through sortedValues.
+    """
+    if not sortedValues:
+        return(0.0)
+    return(sortedValues[int(round(fraction * (len(sortedValues) - 1)))])
+
+
+def throughputDistribution(records):
+    """
+    Summarise how many source bytes per second we translate a page at.
+    Only pages that were translated are included.
+    """
+    rates = sorted([record["bytesPerSecond"] for record in records
+                    if record["status"] == "translated"])
+    distribution = {"pages": len(rates)}
+    for name, fraction in [("min", 0.0), ("p10", 0.1), ("p25", 0.25), ("median", 0.5),
+                           ("p75", 0.75), ("p90", 0.9), ("max", 1.0)]:
+        distribution[name] = percentile(rates, fraction)
+    totalSeconds = sum([record["total"] for record in records
+                        if record["status"] == "translated"])
+    totalBytes = sum([record["srcBytes"] for record in records
+                      if record["status"] == "translated"])
+    if totalSeconds > 0:
+        distribution["overall"] = totalBytes / totalSeconds
+    else:
+        distribution["overall"] = 0.0
+    return(distribution)
+
+
+def writeReport(reportPath, records, nSlowest):
+    """
+    Write the timing report, and print the slowest pages.
+
+    CSV reports have one row per page, slowest page first.  JSON reports list
+    the pages in name order, and also include the slowest pages and the bytes
+    per second distribution.
+    """
+    bySlowest = sorted(records, key=lambda record: record["total"], reverse=True)
+    slowest = bySlowest[0:nSlowest]
+    distribution = throughputDistribution(records)
+
+    columns = (["page", "status", "kind", "dest", "srcBytes", "destBytes", "total"] + TIMED_PHASES +
+               ["bytesPerSecond", "workerRss", "destSha256", "packratLookups", "packratHits",
+                "unparsedBlocks", "error"])
+    if reportPath.lower().endswith(".csv"):
+        with open(reportPath, "w", newline="") as reportFile:
+            writer = csv.DictWriter(reportFile, fieldnames=columns)
+            writer.writeheader()
+            for record in bySlowest:
+                writer.writerow(record)
+    else:
+        with open(reportPath, "w") as reportFile:
+            json.dump({"pages": sorted(records, key=lambda record: record["page"]),
+                       "slowest": slowest,
+                       "bytesPerSecond": distribution,
+                       "workers": workerStats},
+                      reportFile, indent=2)
+            reportFile.write("\n")
+
+    print("Slowest " + str(len(slowest)) + " pages:")
+    for record in slowest:
+        print("  %8.3fs  %9d bytes  %s" % (record["total"], record["srcBytes"], record["page"]))
+    print("Bytes per second: min %.0f, median %.0f, p90 %.0f, max %.0f, overall %.0f" % (
+        distribution["min"], distribution["median"], distribution["p90"],
+        distribution["max"], distribution["overall"]))
+    if args.args.packrat:
+        lookups = sum([record.get("packratLookups", 0) for record in records])
+        hits = sum([record.get("packratHits", 0) for record in records])
+        print("Packrat memo: %d hits in %d lookups (%.1f%%)" % (
+            hits, lookups, 100.0 * hits / max(lookups, 1)))
+
+
+def collectPages(srcdir):
+    """
+    Return the path, relative to srcdir, of every Moin page under srcdir.
+    Pages are in the order traverse visits them: each directory's pages in
+    name order, then its subdirectories in name order.
+    """
+    pages = []
+    for root, dirs, files in os.walk(srcdir):
+        dirs.sort()                       # os.walk visits dirs in this order
+        relRoot = os.path.relpath(root, srcdir)
+        for file in sorted(files):
+            if relRoot == ".":
+                pages.append(file)
+            else:
+                pages.append(relRoot.replace(os.sep, "/") + "/" + file)
+    return(pages)
+
+
+def pagePaths(page):
+    """
+    Given the path of a page relative to --srcdir, return the source file,
+    destination file, wiki root of the page and its depth.  Lays pages out
+    the same way traverse does.
+    """
+    pageDirs = page.split("/")
+    pageName = pageDirs.pop()[:-5]
+    srcfile = args.args.srcdir + "/" + page
+    destfile = "/".join([args.args.destdir] + pageDirs + [pageName, "index.md"])
+    pageRoot = "/".join([args.args.wikiroot] + pageDirs + [pageName])
+    return(srcfile, destfile, pageRoot, len(pageDirs))
+
+
+def pageCosts(pages, schedule, previousReportPath=None):
+    """
+    Estimate how long each page will take to translate, so the longest ones
+    can be started first.  With a handful of huge pages among thousands of
+    small ones, starting the huge ones last leaves one worker busy long after
+    the others have finished.
+
+    Returns a dict of page: cost, where only the order of the costs matters.
+      size: size of the source file
+      time: seconds the page took in the previous run's report.  Pages that
+            aren't in the report are estimated from their size, using the
+            previous run's overall bytes per second.
+    """
+    costs = {}
+    for page in pages:
+        costs[page] = os.path.getsize(args.args.srcdir + "/" + page)
+    if schedule == "time":
+        previousReport = readPreviousReport(previousReportPath)
+        bytesPerSecond = previousReport["bytesPerSecond"]["overall"] or 1.0
+        previousTimes = {}
+        for record in previousReport["pages"]:
+            previousPage = os.path.relpath(record["page"], args.args.srcdir).replace(os.sep, "/")
+            previousTimes[previousPage] = record["total"]
+        for page in pages:
+            costs[page] = previousTimes.get(page, costs[page] / bytesPerSecond)
+    return(costs)
+
+
+def schedulePages(pages, schedule, previousReportPath=None):
+    """
+    Return pages in the order they should be handed out.
+    """
+    if schedule == "walk":
+        return(pages)
+    costs = pageCosts(pages, schedule, previousReportPath)
+    return(sorted(pages, key=lambda page: (-costs[page], page)))
+
+
+def migratePage(page, writer=None):
+    """
+    Translate one page, given its path relative to --srcdir.  Creates the
+    page's directory, and removes it again if the page isn't translated.
+    (A writer, or background pageWriter, creates directories itself, as it
+    needs them.)
+
+    Returns True if the page was translated, False if it contains markup we
+    don't translate.
+    """
+    srcfile, destfile, pageRoot, depth = pagePaths(page)
+    if writer is not None or pageWriter is not None:
+        return(translatePage(srcfile, destfile, pageRoot, depth, writer))
+    fileDestDir = os.path.dirname(destfile)
+    fileDestDirNew = not os.path.exists(fileDestDir)
+    if fileDestDirNew:
+        os.makedirs(fileDestDir, exist_ok=True)
+    translated = False
+    try:
+        translated = translatePage(srcfile, destfile, pageRoot, depth)
+    finally:
+        if not translated and fileDestDirNew: # clean up
+            try:
+                os.rmdir(fileDestDir)
+            except OSError:
+                pass                      # subpages have been put in it
+    return(translated)
+
+
+def runQueue(queue):
+    """
+    Claim and translate pages from the work queue until there are none left.
+    """
+    if not queue.isLoaded():
+        pages = collectPages(args.args.srcdir)
+        if args.args.onlynew:
+            pages = [page for page in pages if not os.path.exists(pagePaths(page)[1])]
+        if args.args.schedule == "walk":
+            costs = None
+        else:
+            costs = pageCosts(pages, args.args.schedule, args.args.previousreport)
+        nAdded = queue.load(pages, costs)
+        print("Loaded " + str(nAdded) + " pages into " + queue.dbPath)
+
+    while True:
+        page = queue.claim()
+        if page is None:
+            break
+        print ('.' * page.count("/"), 'FILE:', page)
+        try:
+            translated = migratePage(page)
+        except pageWriters.WriteError as e:
+            queue.finish(page, "failed", error=type(e).__name__ + ": " + str(e))
+            raise
+        except Exception as e:
+            # Don't let one bad page stop the worker; record it in the queue.
+            queue.finish(page, "failed", error=type(e).__name__ + ": " + str(e))
+        else:
+            record = pageTimings[-1]
+            if translated:
+                queue.finish(page, "done", record)
+            elif record["status"] == "failed":
+                queue.finish(page, "failed", record, record["error"])
+            else:
+                queue.finish(page, "failed", record, notImplementedPages[-1][1])
+
+
+def statIndex(srcdir):
+    """
+    Return the modification time and size of every page under srcdir, keyed by
+    the page's path relative to srcdir.  Uses scandir, so walking even a large
+    mirror is cheap enough to do every second.
+    """
+    index = {}
+    relDirs = [""]
+    while relDirs:
+        relDir = relDirs.pop()
+        with os.scandir(srcdir + "/" + relDir) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    relDirs.append(relDir + entry.name + "/")
+                else:
+                    stat = entry.stat()
+                    index[relDir + entry.name] = (stat.st_mtime_ns, stat.st_size)
+    return(index)
+
+
+def forgetPage(srcfile):
+    """
+    Drop what earlier translations of srcfile recorded, before retranslating
+    it, so each page only has its latest record.
+    """
+    global notImplementedPages, failedPages, pageTimings
+    pageTimings = [record for record in pageTimings if record["page"] != srcfile]
+    notImplementedPages = [probs for probs in notImplementedPages if probs[0] != srcfile]
+    failedPages = [probs for probs in failedPages if probs[0] != srcfile]
+
+
+def watch(index, interval):
+    """
+    Retranslate pages whenever their source changes, until interrupted.
+
+    index: statIndex of the source dir as of the last translation.
+    interval: seconds to wait between checks.
+
+    The parser stays loaded between checks, so retranslating a page costs only
+    the translation itself.  A retranslated page's new record replaces its
+    old one, so the hashes written after each check are of the latest
+    translations, however long we watch.
+    """
+    print("Watching " + args.args.srcdir + " for changes.  Ctrl-C to stop.")
+    try:
+        while True:
+            time.sleep(interval)
+            newIndex = statIndex(args.args.srcdir)
+            changed = sorted([page for page, stamp in newIndex.items()
+                              if index.get(page) != stamp])
+            removed = sorted(set(index.keys()) - set(newIndex.keys()))
+            index = newIndex
+
+            for page in removed:
+                print("REMOVED:", page, "(translation left in place)")
+            for page in changed:
+                if args.args.shard:
+                    shardIdx, nShards = args.args.shard
+                    if pageShard(args.args.srcdir + "/" + page, nShards) != shardIdx:
+                        continue          # some other shard's page
+                print ('.' * page.count("/"), 'CHANGED:', page)
+                forgetPage(pagePaths(page)[0])
+                try:
+                    if not migratePage(page):
+                        if pageTimings[-1]["status"] == "failed":
+                            print("            Err: " + pageTimings[-1]["error"])
+                        else:
+                            print("            Err: " + notImplementedPages[-1][1])
+                except pageWriters.WriteError:
+                    raise
+                except Exception as e:
+                    # Editors are mid-edit; report it and wait for the next change.
+                    print("            Err: " + type(e).__name__ + ": " + str(e))
+            if pageWriter is not None:
+                pageWriter.flush()
+            if args.args.hashes and changed:
+                writeHashes(args.args.hashes)
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+
+
+def currentRss():
+    """
+    Return the resident memory of this process, in bytes.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return(int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE"))
+    except (OSError, ValueError):
+        # No /proc (e.g., macOS).  Fall back to the peak, which only goes up.
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return(peak)                  # already in bytes
+        return(peak * 1024)
+
+
+def poolWorker(options, tasks, results, maxPages, maxRss):
+    """
+    Translate pages from the tasks queue until told to stop (None), or until
+    this worker has done maxPages pages or grown past maxRss bytes.  Either
+    limit can be 0 for no limit.
+
+    Posts a message to results when starting a page, and another when done.
+    The done message says whether this worker is retiring, so the pool can
+    start a replacement.
+
+    With --backgroundwrites each worker has its own writer thread, started
+    after the fork.  If it fails to write a page the worker exits with an
+    error, which the pool notices when it joins the worker.  With
+    --outputarchive, pages are sent back in the done message instead, and the
+    pool writes them to the archive.
+    """
+    global args
+    args = Argghhs(options)
+    startPageWriter(inWorker=True)
+    pid = os.getpid()
+    nPages = 0
+    while True:
+        page = tasks.get()
+        if page is None:
+            break
+        results.put(("start", pid, page))
+        try:
+            translated = migratePage(page)
+        except Exception:
+            results.put(("error", pid, page, traceback.format_exc()))
+            break
+        nPages += 1
+        record = pageTimings[-1]
+        record["workerRss"] = currentRss()
+        notImplemented = None
+        if record["status"] == "notimplemented":
+            notImplemented = notImplementedPages[-1]
+        retiring = ((maxPages and nPages >= maxPages) or
+                    (maxRss and record["workerRss"] >= maxRss))
+        written = []
+        if isinstance(pageWriter, pageWriters.CollectingWriter):
+            written = pageWriter.take()
+        results.put(("page", pid, page, record, notImplemented, retiring, written))
+        if retiring:
+            break
+    if pageWriter is not None:
+        pageWriter.close()
+
+
+def runPool(pages, nJobs, maxPages, maxRss, writeOrder=None):
+    """
+    Translate pages using nJobs worker processes.  Workers are replaced after
+    maxPages pages or once they use more than maxRss bytes (0 = no limit), so
+    state that builds up in the parser can't grow without bound.
+
+    Pages that workers send back (with --outputarchive) are written in
+    writeOrder, no matter what order the workers finish them in, so the
+    archive is the same every time.  Pages that finish early wait in a
+    reorder buffer.  writeOrder defaults to pages.
+    """
+    global workerStats
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for page in pages:
+        tasks.put(page)
+    for i in range(nJobs):
+        tasks.put(None)                   # one stop sign per worker
+
+    workers = {}                          # pid: Process
+    currentPage = {}                      # pid: page being translated
+    peakRss = {}                          # pid: highest resident memory seen
+    rssSamples = []
+    stats = {"started": 0, "recycled": 0}
+    if writeOrder is None:
+        writeOrder = pages
+    reorder = pageWriters.ReorderingWriter(pageWriter, writeOrder)
+
+    def startWorker():
+        worker = multiprocessing.Process(
+            target=poolWorker, args=(args.args, tasks, results, maxPages, maxRss))
+        worker.start()
+        workers[worker.pid] = worker
+        stats["started"] += 1
+
+    def stopWorkers():
+        for worker in workers.values():
+            worker.terminate()
+            worker.join()
+
+    def joinWorker(pid):
+        worker = workers.pop(pid)
+        worker.join()
+        if worker.exitcode != 0 and pid not in currentPage:
+            stopWorkers()
+            raise RuntimeError("Worker " + str(pid) + " failed with exit code " +
+                               str(worker.exitcode) + " after its last page")
+
+    def handle(message):
+        kind, pid = message[0], message[1]
+        if kind == "start":
+            currentPage[pid] = message[2]
+            stats["pagesStarted"] = stats.get("pagesStarted", 0) + 1
+        elif kind == "page":
+            page, record, notImplemented, retiring, written = message[2:]
+            del currentPage[pid]
+            reorder.finish(page, written)
+            print ('.' * page.count("/"), 'FILE:', page)
+            pageTimings.append(record)
+            if notImplemented:
+                notImplementedPages.append(notImplemented)
+            if record["status"] == "failed":
+                failedPages.append([record["page"], record["error"]])
+            rssSamples.append(record["workerRss"])
+            peakRss[pid] = max(peakRss.get(pid, 0), record["workerRss"])
+            stats["pagesDone"] = stats.get("pagesDone", 0) + 1
+            if retiring:
+                joinWorker(pid)
+                stats["recycled"] += 1
+                startWorker()
+        elif kind == "error":
+            stopWorkers()
+            raise RuntimeError("Worker failed translating " + message[2] + ":\n" + message[3])
+
+    for i in range(min(nJobs, len(pages))):
+        startWorker()
+
+    while stats.get("pagesDone", 0) < len(pages):
+        try:
+            handle(results.get(timeout=1))
+        except queueModule.Empty:
+            # Check for workers that died without telling us (e.g., killed for
+            # using too much memory).  Anything they sent before dying has
+            # arrived by now.
+            dead = [pid for pid, worker in workers.items() if not worker.is_alive()]
+            while True:
+                try:
+                    handle(results.get_nowait())
+                except queueModule.Empty:
+                    break
+            for pid in dead:
+                if pid not in workers:
+                    continue              # retired normally while we drained
+                if pid in currentPage:
+                    workers.pop(pid).join()
+                    stopWorkers()
+                    raise RuntimeError("Worker " + str(pid) + " died translating " +
+                                       currentPage[pid])
+                joinWorker(pid)
+                if stats.get("pagesStarted", 0) < len(pages):
+                    startWorker()
+
+    for pid in list(workers.keys()):
+        joinWorker(pid)
+
+    workerStats = {
+        "workersStarted": stats["started"],
+        "workersRecycled": stats["recycled"],
+        "peakRss": max(rssSamples or [0]),
+        "averageRss": sum(rssSamples) / max(len(rssSamples), 1),
+        "averagePeakRssPerWorker": sum(peakRss.values()) / max(len(peakRss), 1)}
+    print("Workers: %d started, %d recycled.  Memory: peak %.1f MB, average %.1f MB" % (
+        workerStats["workersStarted"], workerStats["workersRecycled"],
+        workerStats["peakRss"] / 1048576.0, workerStats["averageRss"] / 1048576.0))
+
+
+def runThreadPool(pages, nJobs, writeOrder=None):
+    """
+    Translate pages using nJobs threads in this process.  Translations don't
+    share any state, so the threads share the loaded grammar and write their
+    results straight into pageTimings, with no pickling or forking.  On a
+    Python with a GIL only one thread parses at a time, though file I/O still
+    overlaps.
+
+    As with runPool, pages for an --outputarchive are written in writeOrder.
+    """
+    tasks = queueModule.Queue()
+    for page in pages:
+        tasks.put(page)
+    if writeOrder is None:
+        writeOrder = pages
+    reorder = pageWriters.ReorderingWriter(pageWriter, writeOrder)
+    failures = []
+
+    def threadWorker():
+        while not failures:
+            try:
+                page = tasks.get_nowait()
+            except queueModule.Empty:
+                return
+            print ('.' * page.count("/"), 'FILE:', page)
+            written = []
+            try:
+                if args.args.outputarchive:
+                    # Collect the page, so the archive gets pages in order.
+                    migratePage(page, lambda destFilePath, markdownText:
+                                written.append((destFilePath, markdownText)))
+                else:
+                    migratePage(page)
+                reorder.finish(page, written)
+            except Exception:
+                failures.append([page, traceback.format_exc()])
+                return
+
+    threads = [threading.Thread(target=threadWorker, name="translator-" + str(i))
+               for i in range(min(nJobs, len(pages)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise RuntimeError("Thread failed translating " + failures[0][0] + ":\n" +
+                           failures[0][1])
+
+
 def traverse(srcdir, destdir, wikiroot, depth):
     """
     Implement each individual Moin page as it's own directory, with the text of the page in
@@ -45,42 +892,108 @@ def traverse(srcdir, destdir, wikiroot, depth):
     global notImplementedPages, args
     
     for root, dirs, files in os.walk(srcdir):
-        for file in files:
+        for file in sorted(files):        # same order on every filesystem
+            if args.args.shard:
+                shardIdx, nShards = args.args.shard
+                if pageShard(srcdir + '/' + file, nShards) != shardIdx:
+                    continue              # some other shard's page
             pageName = file[:-5]
             fileDestDir = destdir + '/' + pageName
             fileDestDirNew = False
-            if not os.path.exists(fileDestDir):
+            if pageWriter is None and not os.path.exists(fileDestDir):
                 os.mkdir(fileDestDir)
                 fileDestDirNew = True
             destfile = fileDestDir + '/index.md'
             srcfile = srcdir + '/' + file
             if (not args.args.onlynew) or (not os.path.exists(destfile)):
                 print ('.' * depth, 'FILE:', file)
-                try:
-                    parseMoinToMarkdown.translate(srcfile, destfile, wikiroot + "/" + pageName, depth)
-                except NotImplementedError as e:
-                    notImplementedPages.append([srcfile, e.args[0]])
+                if not translatePage(srcfile, destfile, wikiroot + "/" + pageName, depth):
                     if fileDestDirNew: # clean up
                         os.rmdir(fileDestDir)
 
-        for dir in dirs:
+        for dir in sorted(dirs):
             print ('.' * depth, 'DIR: ', dir)
             newdir = destdir + '/' + dir
-            if not os.path.exists(newdir):
+            if pageWriter is None and not os.path.exists(newdir):
                 os.mkdir(newdir)
             traverse(srcdir + '/' + dir, newdir, wikiroot + "/" + dir, depth+1)
         return()
     
-args = Argghhs()
+if __name__ == "__main__":
+    args = Argghhs()
 
-# Walk source dir, translating pages as we find them.
+    if args.args.queuestatus:
+        queue = migrationQueue.MigrationQueue(args.args.queue, args.args.lease)
+        queue.printStatus()
+        queue.close()
+        raise SystemExit(0)
 
-traverse(args.args.srcdir, args.args.destdir, args.args.wikiroot, 0)
+    if args.args.watch:
+        # Index before translating, so changes made while we translate get picked up.
+        watchIndex = statIndex(args.args.srcdir)
 
-print("Number of Not Implemented pages: " + str(len(notImplementedPages)))
-for probs in notImplementedPages:
-    print("  Page: " + probs[0])
-    print("            Err: " + probs[1] + "\n")
+    if args.args.queue:
+        # Work through the shared queue, rather than walking the source dir.
+        queue = migrationQueue.MigrationQueue(args.args.queue, args.args.lease)
+        runQueue(queue)
+    elif args.args.jobs > 1:
+        # Hand the pages out to a pool of worker processes (or threads).
+        if args.args.outputarchive or args.args.backend == "thread":
+            startPageWriter()             # threads share this process's writer
+        pages = collectPages(args.args.srcdir)
+        if args.args.shard:
+            shardIdx, nShards = args.args.shard
+            pages = [page for page in pages
+                     if pageShard(args.args.srcdir + "/" + page, nShards) == shardIdx]
+        if args.args.onlynew:
+            pages = [page for page in pages if not os.path.exists(pagePaths(page)[1])]
+        scheduled = schedulePages(pages, args.args.schedule, args.args.previousreport)
+        if args.args.backend == "thread":
+            runThreadPool(scheduled, args.args.jobs, writeOrder=pages)
+        else:
+            runPool(scheduled, args.args.jobs, args.args.maxpagesperworker,
+                    int(args.args.maxworkerrss * 1048576), writeOrder=pages)
+    else:
+        # Walk source dir, translating pages as we find them.
+        startPageWriter()
+        traverse(args.args.srcdir, args.args.destdir, args.args.wikiroot, 0)
 
+    if pageWriter is not None:
+        pageWriter.flush()                # everything is on disk before we report
 
-    
+    notImplementedPages.sort()            # --jobs workers finish in any order
+    print("Number of Not Implemented pages: " + str(len(notImplementedPages)))
+    for probs in notImplementedPages:
+        print("  Page: " + probs[0])
+        print("            Err: " + probs[1] + "\n")
+    if failedPages:
+        failedPages.sort()
+        print("Number of failed pages: " + str(len(failedPages)))
+        for probs in failedPages:
+            print("  Page: " + probs[0])
+            print("            Err: " + probs[1] + "\n")
+    unparsedPages = [record["page"] for record in pageTimings if record["unparsedBlocks"]]
+    if unparsedPages:
+        print("Number of pages with blocks passed through as PLACEHOLDER_UNPARSED: " +
+              str(len(unparsedPages)))
+        for page in sorted(unparsedPages):
+            print("  Page: " + page)
+
+    if args.args.report:
+        writeReport(args.args.report, pageTimings, args.args.slowest)
+
+    if args.args.manifest:
+        writeManifest(args.args.manifest)
+
+    if args.args.hashes:
+        writeHashes(args.args.hashes)
+
+    if args.args.queue:
+        queue.printStatus()
+        queue.close()
+
+    if args.args.watch:
+        watch(watchIndex, args.args.interval)
+
+    if pageWriter is not None:
+        pageWriter.close()
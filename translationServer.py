@@ -0,0 +1,172 @@
+#!/usr/local/bin/python3
+# -*- coding: utf-8 -*-
+#
+# Keep parseMoinToMarkdown loaded and translate pages on request, so editor
+# previews and other tools don't pay for starting Python and setting up the
+# grammar for every page.
+#
+# Requests and responses are JSON, one object per line.  A request is:
+#
+#   {"id": 1, "text": "= Moin page =\n...", "wikiroot": "/src", "depth": 0}
+#
+# id is optional and is copied into the response, even when the request is
+# rejected, as long as it is an object.  wikiroot and depth
+# default to the --wikiroot and --depth the server was started with.  The
+# response is:
+#
+#   {"id": 1, "ok": true, "markdown": "...", "frontMatter": {"title": "..."},
+#    "page": "...", "diagnostics": [], "seconds": 0.012}
+#
+# markdown is the translated page without its front matter; page is what
+# runMigration.py would write, front matter and all.  If the page can't be
+# translated, ok is false, notImplemented says whether that's because it uses
+# markup we deliberately don't translate, and diagnostics says why.
+# Diagnostics are {"level": "error" or "warning", "message": "..."}.
+#
+# Connections are handled in threads, each translating its own pages.
+
+import argparse
+import io
+import json
+import os
+import socketserver
+import stat
+import sys
+import time
+import parseMoinToMarkdown
+
+
+class Argghhs(object):
+    """
+    Process and provide access to command line arguments.
+    """
+
+    def __init__(self):
+        argParser = argparse.ArgumentParser(
+            description="Translate MoinMoin pages to Markdown on request.  Reads JSON-lines requests from stdin (or a Unix socket) and writes JSON-lines responses.",
+            epilog="Example: " + os.path.basename(__file__) +
+            " --socket /tmp/moin2md.sock --wikiroot /src")
+        argParser.add_argument(
+            "--socket", required=False, default=None,
+            help="Listen on this Unix socket, rather than reading stdin.  Any number of clients can connect; each sends requests and reads responses, a line at a time.")
+        argParser.add_argument(
+            "--wikiroot", required=False, default="/src",
+            help="Root of all links used inside the wiki, when a request doesn't say.  Default is /src.")
+        argParser.add_argument(
+            "--depth", required=False, type=int, default=0,
+            help="How deep in the directory structure pages are, when a request doesn't say.  0 = top")
+        argParser.add_argument(
+            "--runtests", required=False,
+            help="Run Unit Tests, rather than serving requests.",
+            action="store_true")
+        self.args = argParser.parse_args()
+
+        return(None)
+
+
+def translateRequest(requestLine):
+    """
+    Translate the page in one JSON request line.  Returns the response, as a
+    dict.
+    """
+    response = {"ok": False, "diagnostics": []}
+    try:
+        request = json.loads(requestLine)
+        if isinstance(request, dict) and "id" in request:
+            response["id"] = request["id"]    # so pipelined clients can match errors too
+        if not isinstance(request, dict) or not isinstance(request.get("text"), str):
+            raise ValueError("request must be an object with a text string")
+    except ValueError as e:
+        response["diagnostics"].append({"level": "error", "message": "Bad request: " + str(e)})
+        return(response)
+
+    start = time.perf_counter()
+    try:
+        translation = parseMoinToMarkdown.translateMoinText(
+            request["text"],
+            request.get("wikiroot", args.args.wikiroot),
+            int(request.get("depth", args.args.depth)))
+        response["ok"] = True
+        response["markdown"] = translation.markdown
+        response["frontMatter"] = translation.frontMatter
+        response["page"] = translation.page()
+        for warning in translation.diagnostics:
+            response["diagnostics"].append({"level": "warning", "message": warning})
+    except NotImplementedError as e:
+        response["notImplemented"] = True
+        response["diagnostics"].append({"level": "error", "message": e.args[0]})
+    except Exception as e:
+        response["notImplemented"] = False
+        response["diagnostics"].append(
+            {"level": "error", "message": type(e).__name__ + ": " + str(e)})
+    response["seconds"] = time.perf_counter() - start
+    return(response)
+
+
+def serveStream(inStream, outStream):
+    """
+    Answer requests from inStream, one line each, until it is closed.
+    """
+    for requestLine in inStream:
+        if not requestLine.strip():
+            continue
+        outStream.write(json.dumps(translateRequest(requestLine), sort_keys=True) + "\n")
+        outStream.flush()
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """
+    One client connection on the Unix socket.
+    """
+
+    def handle(self):
+        inStream = io.TextIOWrapper(self.rfile, encoding="utf-8")
+        outStream = io.TextIOWrapper(self.wfile, encoding="utf-8", write_through=True)
+        try:
+            serveStream(inStream, outStream)
+        except (BrokenPipeError, ConnectionResetError):
+            pass                          # client went away
+
+
+class TranslationServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def runTests():
+    response = translateRequest(json.dumps({"id": 3, "text": "= Title =\nSome '''text'''\n"}))
+    if (not response["ok"] or response["id"] != 3 or
+        response["markdown"] != "# Title\n\nSome **text**\n"):
+        raise BaseException("translateRequest")
+
+    # Bad requests still get their id back, if they have one.
+    for requestLine, responseId in [('{"id": 7}', 7),
+                                    ('{"id": "a", "text": 1}', "a"),
+                                    ('["id", 7]', None),
+                                    ('{"id": 7, ', None)]:
+        response = translateRequest(requestLine)
+        if (response["ok"] or response.get("id") != responseId or
+            not response["diagnostics"][0]["message"].startswith("Bad request: ")):
+            raise BaseException("translateRequest bad request")
+    return
+
+
+if __name__ == "__main__":
+    args = Argghhs()
+
+    if args.args.runtests:
+        runTests()
+    elif args.args.socket:
+        if os.path.exists(args.args.socket) and stat.S_ISSOCK(os.stat(args.args.socket).st_mode):
+            os.remove(args.args.socket)   # left over from a previous server
+        server = TranslationServer(args.args.socket, RequestHandler)
+        print("Translating requests on " + args.args.socket + ".  Ctrl-C to stop.",
+              file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(args.args.socket)
+    else:
+        serveStream(sys.stdin, sys.stdout)